@@ -0,0 +1,115 @@
+import re
+import sys
+import json
+import logging
+from pathlib import Path
+
+import downloads
+from pieces import progress_path
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# the manifest asking for every file the client does not have
+MISSING = 'missing'
+
+
+def read_manifest(path):
+    '''
+    Function to read the files to download from a manifest. File numbers or
+    names like 3.txt are separated by commas, spaces or new lines, anything
+    after a # is a comment. Returns the file numbers in manifest order,
+    raises ValueError naming the line of a token that is not a file
+    param path : path of the manifest, - for stdin
+    '''
+    text = sys.stdin.read() if path == '-' else Path(path).read_text()
+    file_nos = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        for name in re.split(r'[,\s]+', line.split('#')[0]):
+            if len(name) == 0:
+                continue
+            number = name[:-4] if name.endswith('.txt') else name
+            if not re.fullmatch(r'[0-9]+', number):
+                raise ValueError(f"line {line_no}: {name!r} is not a file "
+                                 "number or name like 3.txt")
+            file_no = int(number)
+            if file_no not in file_nos:
+                file_nos.append(file_no)
+    return file_nos
+
+
+def missing_files(file_vector, down_loca):
+    '''
+    Function to get the files of the catalog a client neither holds nor has
+    downloaded already, partial downloads are resumed
+    param file_vector : file vector of the client, one entry per file
+    param down_loca : path of the downloads of the client
+    '''
+    def downloaded(i):
+        path = Path(down_loca) / f"{i}.txt"
+        return path.exists() and not progress_path(path).exists()
+    return [i for i in range(len(file_vector)) if file_vector[i] != '1'
+            and not downloaded(i)]
+
+
+def summarize(client_id, file_nos, results, elapsed):
+    '''
+    Function to build the summary of a batch run
+    param client_id : id of the client
+    param file_nos : numbers of the files asked for
+    param results : dictionary of file number to its Download, files
+                    without one were not found on any peer. None if the
+                    connection to the main server was lost before the
+                    files were looked up
+    param elapsed : seconds the batch took
+    '''
+    files = []
+    for file_no in file_nos:
+        download = None if results is None else results.get(file_no)
+        if download is None:
+            status = 'not found' if results is not None else 'lost'
+            files.append({'file': f"{file_no}.txt", 'status': status,
+                          'latency': None, 'wait': None, 'bytes': 0,
+                          'retries': 0})
+            continue
+        latency = wait = None
+        if download.started_at is not None:
+            wait = round(download.started_at - download.queued_at, 4)
+            if download.ended_at is not None:
+                latency = round(download.ended_at - download.started_at, 4)
+        files.append({'file': f"{file_no}.txt", 'status': download.status,
+                      'latency': latency, 'wait': wait,
+                      'bytes': download.received,
+                      'retries': download.retries})
+    done = [f for f in files if f['status'] == downloads.DONE]
+    total = sum(f['bytes'] for f in done)
+    return {'client': client_id,
+            'requested': len(file_nos),
+            'done': len(done),
+            'failed': len(files) - len(done),
+            'bytes': total,
+            'elapsed': round(elapsed, 4),
+            'throughput': round(total / elapsed, 1) if elapsed > 0 else None,
+            'files': files}
+
+
+def quiet_stdout():
+    '''
+    Function to send everything printed from now on to stderr, so the
+    summary of a batch run is the only output on stdout and can be piped
+    to other tools
+    '''
+    sys.stdout = sys.stderr
+
+
+def write_summary(summary, path):
+    '''
+    Function to write a summary as JSON, on a single line for stdout
+    param summary : summary built by summarize
+    param path : path to write to, - for stdout
+    '''
+    if path == '-':
+        print(json.dumps(summary), file=sys.__stdout__, flush=True)
+    else:
+        Path(path).write_text(json.dumps(summary, indent=2) + "\n")
+        logger.info(f"Summary written to {path}")
@@ -8,33 +8,51 @@ from inputimeout import inputimeout, TimeoutOccurred
 import argparse
 import time
 import constants
-from main_serv import MainServerConn
 
-from p2p import myUDPClient, myUDPServer
+from p2p import myUDPClient, RecvWindow, new_server
+from pieces import ChunkQueue, PieceChecker, decode_manifest, \
+    load_progress, remove_progress, save_progress
+from downloads import DownloadManager
+import batch
+import compress
+import packet
 
 
 import sys
 sys.path.append(str(Path(__file__).parent.parent.absolute()))
-print(Path(__file__).parent.parent.absolute())
 
 from client_utils import ClientFile
-from utils import verify_hash
+from main_serv import MainServerConn
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
 class Client():
-    def __init__(self, config_file_path):
+    def __init__(self, config_file_path, manifest=None,
+                 parallel=constants.CLIENT_BULK_DOWNLOADS, summary='-'):
+        '''
+        Constructor for the client, runs it until it exits
+        param config_file_path : path of the config of the client
+        param manifest : None for the interactive prompt, otherwise the
+                         file numbers to download or batch.MISSING for
+                         every file the client does not have
+        param parallel : number of files downloaded at once
+        param summary : where a batch run writes its summary, - for stdout
+        '''
         # reach out to server to share config
         if not Path(config_file_path).is_file():
             logger.error("Config file does not exist")
             exit(1)
         with open(config_file_path, 'r') as f:
             config = yaml.load(f, Loader=yaml.Loader)
-        print("Client with following config is being loaded.. (10s to init)")
-        print(config)
-        time.sleep(10.0)
+        # whether every file of a batch run was downloaded
+        self.batch_ok = None if manifest is None else False
+        if manifest is None:
+            print("Client with following config is being loaded.. "
+                  "(10s to init)")
+            print(config)
+            time.sleep(10.0)
         self.client_id = config['CLIENTID']
         self.file_vector = config['FILE_VECTOR']
         self.my_port = config['MYPORT']
@@ -44,6 +62,9 @@ class Client():
         self.down_loca = (self.file_loca/'downloads')
         self.down_loca.mkdir(parents=True, exist_ok=True)
         self.client_file_mgr = ClientFile(self.file_vector, self.file_loca)
+        # hash the files in the background, requests reuse the hashes
+        threading.Thread(target=self.client_file_mgr.hashAll,
+                         daemon=True).start()
         logging.info("Done with config initialization")
 
         self.client_shutdown = False
@@ -54,7 +75,7 @@ class Client():
         if (not self.serv_conn.get_conn_status()):
             return
         # then start listening on port
-        my_server = myUDPServer(self.my_port, self.client_file_mgr)
+        my_server = new_server(self.my_port, self.client_file_mgr)
         if (not my_server.check_success()):
             print("P2P Server init failed. Closing client")
             self.serv_conn.set_close()
@@ -63,75 +84,74 @@ class Client():
             server = threading.Thread(target=my_server.listen)
             server.start()
 
-        # open user input
-        input_thread = threading.Thread(target=self.user_input)
-        input_thread.start()
+        # downloads run in the background, the prompt only queues them
+        self.downloads = DownloadManager(self, parallel)
 
-        while (not self.client_shutdown and self.serv_conn.get_conn_status()):
-            # do nothing
-            pass
-        if (not self.serv_conn.get_conn_status()):
-            logger.error("Connection to server lost, client exiting..")
-            self.serv_conn.set_close()
-            my_server.set_close()
+        # open user input, it may be waiting on the prompt when the
+        # connection is lost so it does not hold up the exit. A batch run
+        # has no prompt and exits once its files are done
+        if manifest is None:
+            input_thread = threading.Thread(target=self.user_input,
+                                            daemon=True)
+        else:
+            input_thread = threading.Thread(target=self.run_batch,
+                                            args=(manifest, summary),
+                                            daemon=True)
+        input_thread.start()
 
+        # sleep until the user exits or the main server connection is lost
+        self.serv_conn.closed.wait()
         if (self.client_shutdown):
             logger.info("Client shutdown called, client exiting")
-            if (self.serv_conn.get_conn_status()):
-                self.serv_conn.set_close()
-                my_server.set_close()
+        else:
+            logger.error("Connection to server lost, client exiting..")
+            self.serv_conn.set_close()
+        my_server.set_close()
 
         print("Client shutting down...")
-        input_thread.join()
-        logger.info("input thread joined")
+        self.downloads.close()
+        self.client_file_mgr.saveCache()
+        # a batch run writes its summary once its downloads are cancelled
+        if (self.client_shutdown or manifest is not None):
+            input_thread.join()
+            logger.info("input thread joined")
         server.join()
         logger.info("my server joined")
         del self.serv_conn
 
-    def move_window(self, seq_nos):
-        '''
-        Function to move the client window
-        param seq_nos : dictionary with window of current sequence numbers
-        '''
-        for i in range(len(seq_nos)):
-            seq_nos[i] = (seq_nos[i] + 1) % (constants.MAX_SEQ_NO)
-
-    def write_buffer(self, buffer, writer):
-        '''
-        Function to writer buffer to writer object
-        param buffer : list of byte buffers to write to disk
-        param writer : writer object of type WriteObj used to write to file
-        '''
-        for i in range(len(buffer)):
-            writer.write(buffer[i])
-        buffer.clear()
-
-    def request_cleanup(self, hash, writer, abnormal=False):
+    def request_cleanup(self, hash, writer, abnormal=False, checker=None):
         '''
         Function to do cleanup after request is complete
         param hash : hash of the file, if hash is None, consider it as empty
                      file
         param writer : writer object of type WriteObj used to write to file
         param abnormal (False) : flag to signal if abnormal closure of request
+        param checker : piece checker of the file, the verified pieces of a
+                        download that did not complete are kept to resume
+                        it. None to delete the file
         '''
         file_loc = writer.get_filepath()
-        del writer
+        # blocks still gathered in memory reach the file
+        writer.close()
         if (self.serv_conn.get_conn_status()):
             # connection ended abnormally
             if (abnormal):
-
+                if self._keep_partial(file_loc, checker):
+                    return
                 # remove file
                 if os.path.exists(file_loc):
                     logger.info(f"File deleted: {file_loc} due to server"
                                 "connection lost")
                     os.remove(file_loc)
-                    return
+                remove_progress(file_loc)
+                return
 
+            remove_progress(file_loc)
             # empty file, do nothing
             if (hash is None):
                 logger.info(f"Empty file detected: {file_loc}")
                 return
-            if (verify_hash(hash, file_loc)):
+            if (writer.verify_hash(hash)):
                 # send success to server
                 # TODO: send success message to server
                 logger.info(f"File hash verified: {file_loc}")
@@ -145,201 +165,457 @@ class Client():
                     os.remove(file_loc)
         # lost connection to server, delete file
         else:
+            if self._keep_partial(file_loc, checker):
+                return
             # remove file
             if os.path.exists(file_loc):
                 logger.info(f"File deleted: {file_loc} due to main server"
                             " connection lost")
                 os.remove(file_loc)
+            remove_progress(file_loc)
 
-    def _cleanup_abnormal(self, seq_no, hash, writer, client_sock):
+    def _keep_partial(self, file_loc, checker):
+        '''
+        Function to keep a download that did not complete together with a
+        record of its verified pieces, returns whether it was kept
+        param file_loc : path of the file downloaded
+        param checker : piece checker of the file, None if it has no pieces
         '''
-        Function to handle abnormal cleanup. Send ACK for message run cleanup
-        and finally delete socket object
+        if checker is None or len(checker.verified) == 0:
+            return False
+        save_progress(checker, file_loc)
+        logger.info(f"Kept {len(checker.verified)} of "
+                    f"{checker.manifest.piece_count} pieces of {file_loc} "
+                    "to resume the download")
+        return True
+
+    def _close_abnormal(self, seq_no, client_sock):
+        '''
+        Function to handle an abnormal close by the peer. Send ACK for the
+        closing message
         param seq_no : seq_no of last packet to send ACK for
-        param hash : hash of the file requested
-        param writer : writer object used to write to disk
         param client_sock: client socket object used to communicate with peer
         '''
-        try:
-            logger.error("Connection reset or closed by"
-                         f" {client_sock.get_addr()}")
-            client_sock.send_ack(seq_no, True)
-            self.request_cleanup(hash, writer, True)
-        finally:
-            del client_sock
+        logger.error("Connection reset or closed by"
+                     f" {client_sock.get_addr()}")
+        client_sock.send_ack(seq_no, True)
 
-    def request_file(self, filename, addr, writer):
+    def request_file(self, filename, addr, writer, download=None,
+                     checker=None):
         '''
-        Function to handle request file from a peer
+        Function to handle request file from a peer. Pieces that fail their
+        hash check are requested again, up to CLIENT_PIECE_RETRIES times
         param filename : name/number of the file to request from peer
         param addr : address to find peer at
         param writer : writer object used to writer to disk
+        param download : Download tracking progress and cancellation, if any
+        param checker : piece checker of a download to resume, only its
+                        missing pieces are requested
         '''
         client_sock = myUDPClient(addr)
-        seq_no = (0).to_bytes(1, 'big')
-        pkt_type = constants.DATA_PACKET.to_bytes(1, "big")
-        filename = int(filename).to_bytes(1, "big")
-        data = seq_no + pkt_type + filename
-        client_sock.send(data)
-        client_buffer = []
-        retries = constants.CLIENT_MAX_RETRIES
-        # starting sequence numbers that it should get from the server
-        seq_nos = [0, 1]
-        connEnd = False
-        second_end = False  # if buffer has the ending packet
-        hash = None  # hash of the incoming file
+        refetches = constants.CLIENT_PIECE_RETRIES
+        if checker is None:
+            status, hash, checker = self._receive(filename, client_sock,
+                                                  writer, download=download)
+        else:
+            status, hash = 'done', checker.manifest.file_hash
+            refetches += 1  # the first round fetches the missing pieces
+        while status == 'done' and checker is not None and \
+                not checker.complete() and refetches > 0:
+            refetches -= 1
+            for pieces in checker.missing_ranges():
+                logger.info(f"Requesting pieces {pieces} of {filename} "
+                            f"again from {addr}")
+                if download is not None:
+                    download.add_retry()
+                client_sock = myUDPClient(addr)
+                status, _, _ = self._receive(filename, client_sock, writer,
+                                             checker, pieces, download)
+                if status != 'done':
+                    break
+        if status == 'done':
+            logger.info("Connection complete after receiving file "
+                        f"from {addr}, stats: {client_sock.get_stats()}")
+        return self._finish_request(filename, addr, status, hash, checker,
+                                    writer, download)
 
-        while retries >= 0 and self.serv_conn.get_conn_status() \
-                and (not connEnd):
-            try:
-                data = client_sock.recv()  # try to get data from socket
-                if (data[0] in seq_nos):
-                    if (data[0] == seq_nos[0]):  # expected sequence and hash
-                        # file not on peer
-                        if (data[1] == constants.SERVER_FILE_NOT_FOUND):
-                            logger.error("File not found on peer")
-                            self._cleanup_abnormal(data[0], hash, writer,
-                                                   client_sock)
-                            return False
-
-                        # file empty
-                        if (data[1] == constants.SERVER_END_PACKET):
-                            connEnd = True  # connEnd is set to true
-                            client_sock.send_ack(data[0])
-                            break
-                        # connection ends with message in buffer
-                        if second_end:
-                            connEnd = True
-                        # server shutdown abnormal
-                        if (data[1] == constants.SERVER_END_ABNORMAL):
-                            self._cleanup_abnormal(data[0], hash, writer,
-                                                   client_sock)
-                            return False
-                        hash = data[2:].decode(encoding='utf-8')
-
-                        client_sock.send_ack(data[0])
-                        self.move_window(seq_nos)  # move widow forward
-
-                        # clear buffer and move window forward
-                        if len(client_buffer) > 0:
-                            self.write_buffer(client_buffer, writer)
-                            self.move_window(seq_nos)
-                            client_buffer.clear()
-                    # buffer this, don't move the window forward
-                    elif (data[0] == seq_nos[1]):
-                        # connection ended by server with this packet
-                        if (data[1] == constants.SERVER_END_PACKET):
-                            second_end = True
-
-                        # server shutdown abnormal
-                        if (data[1] == constants.SERVER_END_ABNORMAL):
-                            self._cleanup_abnormal(data[0], hash, writer,
-                                                   client_sock)
-                            return False
-
-                        # append only if there isnt any data in buffer.
-                        # discard packet if repeated
-                        if len(client_buffer) == 0:
-                            # add data to buffer
-                            client_buffer.append(data[2:])
-                        client_sock.send_ack(data[0])
-                        retries = constants.CLIENT_MAX_RETRIES
-                        raise ConnectionError  # try to get hash again
+    def swarm_file(self, filename, addrs, writer, download=None,
+                   checker=None):
+        '''
+        Function to download a file from several peers at once. The first
+        piece and the manifest come from the first peer that answers, the
+        other pieces are split in chunks that the peers take from a shared
+        queue, so faster peers serve more of the file
+        param filename : name/number of the file to request from peers
+        param addrs : addresses of the peers holding the file
+        param writer : writer object used to writer to disk
+        param download : Download tracking progress and cancellation, if any
+        param checker : piece checker of a download to resume, only its
+                        missing pieces are requested
+        '''
+        addrs = list(addrs[:constants.SWARM_MAX_PEERS])
+        # a resumed download starts with its first missing piece
+        first = 0 if checker is None else checker.missing()[0]
+        # get the manifest from the first peer that answers
+        while len(addrs) > 0:
+            status, hash, checker = self._receive(filename,
+                                                  myUDPClient(addrs[0]),
+                                                  writer, checker, (first, 1),
+                                                  download)
+            if status in ('done', 'lost', 'cancelled', 'changed'):
                 break
-            except ConnectionError:
-                retries -= 1
-        if (not self.serv_conn.get_conn_status()):
+            addrs.pop(0)
+        refetches = constants.CLIENT_PIECE_RETRIES
+        while status == 'done' and checker is not None and \
+                not checker.complete() and refetches >= 0:
+            refetches -= 1
+            chunks = ChunkQueue(checker.missing_ranges())
+            # rounds after the first fetch pieces again
+            if download is not None and refetches < \
+                    constants.CLIENT_PIECE_RETRIES - 1:
+                download.add_retry()
+            served = {}
+            workers = [threading.Thread(target=self._swarm_worker,
+                                        args=(filename, addr, writer, checker,
+                                              chunks, served, download))
+                       for addr in addrs]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            logger.info(f"Pieces of {filename} served by peer: {served}")
+            if not self.serv_conn.get_conn_status():
+                status = 'lost'
+            elif download is not None and download.cancelled():
+                status = 'cancelled'
+                break
+            # peers that failed are not asked again
+            addrs = [addr for addr in addrs if served[addr] >= 0]
+            if len(addrs) == 0:
+                status = 'failed'
+        return self._finish_request(filename, addrs, status, hash, checker,
+                                    writer, download)
+
+    def _swarm_worker(self, filename, addr, writer, checker, chunks, served,
+                      download=None):
+        '''
+        Function run by a thread per peer of a swarm download, takes chunks
+        from the queue until they are all fetched or the peer fails. A failed
+        chunk goes back to the queue for the other peers
+        param filename : name/number of the file to request from the peer
+        param addr : address of the peer
+        param writer : writer object used to writer to disk
+        param checker : piece checker of the file
+        param chunks : ChunkQueue shared by the peers
+        param served : pieces served by each peer, -1 once a peer failed
+        param download : Download tracking progress and cancellation, if any
+        '''
+        served[addr] = 0
+        while self.serv_conn.get_conn_status():
+            chunk = chunks.take()
+            if chunk is None:
+                return
+            status = 'failed'
+            try:
+                status, _, _ = self._receive(filename, myUDPClient(addr),
+                                             writer, checker, chunk, download)
+            except Exception as e:  # a broken transfer only fails its peer
+                logger.exception(f"Transfer of pieces {chunk} of {filename} "
+                                 f"from {addr} crashed: {e}")
+            finally:
+                # the other peers wait on a chunk until it is given back
+                chunks.done(chunk, status == 'done')
+            if status != 'done':
+                logger.error(f"Peer {addr} failed pieces {chunk} of "
+                             f"{filename}")
+                served[addr] = -1
+                return
+            served[addr] += chunk[1]
+
+    def _finish_request(self, filename, addr, status, hash, checker,
+                        writer, download=None):
+        '''
+        Function to clean up after the transfers of a file ended, returns
+        whether the file was received
+        param filename : name/number of the file requested
+        param addr : address, or list of addresses of a swarm, of the peers
+        param status : status of the last transfer
+        param hash : hash of the file
+        param checker : piece checker of the file, None for a legacy peer
+        param writer : writer object used to writer to disk
+        param download : Download tracking progress and cancellation, if any
+        '''
+        # download cancelled by the user
+        if status == 'cancelled':
+            logger.info(f"Request for {filename} cancelled")
+            self.request_cleanup(hash, writer, True, checker)
+            return False
+        # peer closed the connection
+        if status == 'closed':
+            self.request_cleanup(hash, writer, True, checker)
+            return False
+        # pieces kept from an earlier download are of another file, they are
+        # dropped and the file is fetched from the start
+        if status == 'changed':
+            logger.error(f"File {filename} changed on peer, download "
+                         "started over")
+            self.request_cleanup(hash, writer, True)
+            if download is not None:
+                download.add_retry()
+            writer = self.client_file_mgr.newWrite(writer.get_filepath())
+            if isinstance(addr, list):
+                return self.swarm_file(filename, addr, writer, download)
+            return self.request_file(filename, addr, writer, download)
+        # connection to main server lost
+        if status == 'lost':
             logger.error("Request file failed due to server connection lost")
-            self.request_cleanup(hash, writer)
-            del client_sock
+            self.request_cleanup(hash, writer, checker=checker)
             return False
-        if connEnd:
-            logger.info("Connection complete after receiving file "
-                        f"from {addr}")
+        if status == 'done' and checker is not None and \
+                not checker.complete():
+            logger.error(f"Pieces {checker.missing()} of {filename} failed "
+                         "hash check after retries")
+            self.request_cleanup(hash, writer, True, checker)
+            return False
+        if status == 'done':  # connection ended
             self.request_cleanup(hash, writer)
-            del client_sock
             return True
-        if retries < 0:
-            logger.error(f"Failed P2P connection to {addr}")
-            print(f"Failed P2P connection to {addr}")
-            del client_sock
-            self.request_cleanup(hash, writer, True)
-            return False
-
+        # retries exceeded
+        logger.error(f"Failed P2P connection to {addr}")
+        print(f"Failed P2P connection to {addr}")
+        self.request_cleanup(hash, writer, True, checker)
+        return False
+
+    def _receive(self, filename, client_sock, writer, checker=None,
+                 pieces=(0, 0), download=None):
+        '''
+        Function to run one transfer from a peer. Returns the status of the
+        transfer ('done', 'closed', 'lost', 'cancelled', 'changed' or
+        'failed'), the hash of the file and the piece checker of the file
+        param filename : name/number of the file to request from peer
+        param client_sock : UDP client connected to the peer
+        param writer : writer object used to writer to disk
+        param checker : piece checker of an earlier transfer of the file,
+                        None to create one from the manifest
+        param pieces : first piece and number of pieces to request, (0, 0)
+                       for the whole file
+        param download : Download tracking progress and cancellation, if any
+        '''
+        client_sock.send_request(filename, pieces)
+        # selective repeat window, buffers packets received out of order
+        recv_window = RecvWindow(client_sock.window_size,
+                                 packet.seq_space(client_sock.version))
+        # state of the transfer, shared with the functions delivering packets
+        transfer = {'filename': filename,
+                    'legacy': client_sock.version ==
+                    constants.LEGACY_PACKET_VERSION,
+                    'writer': writer,
+                    'download': download,
+                    'checker': checker,
+                    'hash': None,  # hash of the incoming file
+                    # first packet delivered is the hash or manifest
+                    'got_hash': False,
+                    # parts of the compressed piece received
+                    'packed': bytearray(),
+                    # set once the transfer is over
+                    'status': None}
         retries = constants.CLIENT_MAX_RETRIES
-        while retries >= 0 and self.serv_conn.get_conn_status() \
-                and (not connEnd):
-            try:
+        started = False  # received anything from the peer yet
 
-                data = client_sock.recv()
-
-                if (data[0] in seq_nos):
-                    if (data[0] == seq_nos[0]):  # expected sequence and hash
-                        # last packet by server
-                        if (data[1] == constants.SERVER_END_PACKET):
-                            connEnd = True
-                        # connection ends with message in buffer
-                        if second_end:
-                            connEnd = True
-
-                        # server shutdown abnormal
-                        if (data[1] == constants.SERVER_END_ABNORMAL):
-                            self._cleanup_abnormal(data[0], hash, writer,
-                                                   client_sock)
-                            return
-
-                        client_sock.send_ack(data[0])
-                        writer.write(data[2:])
-                        self.move_window(seq_nos)
-
-                        if len(client_buffer) > 0:
-                            self.write_buffer(client_buffer, writer)
-                            self.move_window(seq_nos)
-                            client_buffer.clear()
-                        retries = constants.CLIENT_MAX_RETRIES
-
-                    # buffer this, don't move the window forward
-                    elif (data[0] == seq_nos[1]):
-                        # last packet by server
-                        if (data[1] == constants.SERVER_END_PACKET):
-                            second_end = True
-                        # server shutdown abnormal
-                        if (data[1] == constants.SERVER_END_ABNORMAL):
-                            self._cleanup_abnormal(data[0], hash, writer,
-                                                   client_sock)
-                            return False
-                        # add to buffer only if buffer empty, else possiblity
-                        # of duplicates
-                        if len(client_buffer) == 0:
-                            client_buffer.append(data[2:])
-                        client_sock.send_ack(data[0])
-                        retries = constants.CLIENT_MAX_RETRIES
-                        raise ConnectionError  # try to get sequence 1 again
-                else:  # maybe resent data or abnormal closure
-                    if (data[1] == 3):
-                        self._cleanup_abnormal(data[0], hash, writer,
-                                               client_sock)
-                        return False
-                    client_sock.send_ack(data[0])
-                    retries = constants.CLIENT_MAX_RETRIES
-            except ConnectionError:
+        while retries >= 0 and self.serv_conn.get_conn_status() \
+                and transfer['status'] is None:
+            if download is not None and download.cancelled():
+                transfer['status'] = 'cancelled'
+                break
+            pkt = self._next_packet(client_sock, filename, pieces, started,
+                                    download)
+            if pkt is None:
                 retries -= 1
+                continue
+            started = True
+            retries = constants.CLIENT_MAX_RETRIES
+
+            # file not on peer or server shutdown abnormal
+            if pkt.type in (constants.SERVER_FILE_NOT_FOUND,
+                            constants.SERVER_END_ABNORMAL):
+                if pkt.type == constants.SERVER_FILE_NOT_FOUND:
+                    logger.error("File not found on peer")
+                self._close_abnormal(pkt.seq_no, client_sock)
+                transfer['status'] = 'closed'
+                break
 
-        # connection to main server lost
-        if (not self.serv_conn.get_conn_status()):
-            self.request_cleanup(hash, writer)
-            del client_sock
-            return False
-        if connEnd:  # connection ended
-            self.request_cleanup(hash, writer)
-            del client_sock
-            return True
-        if retries < 0:  # retries exceeded
-            logger.error(f"Failed P2P connection to {addr}")
-            print(f"Failed P2P connection to {addr}")
-            del client_sock
-            self.request_cleanup(hash, writer, True)
-            return False
+            # ack everything in the window or already delivered
+            if recv_window.offer(pkt):
+                client_sock.send_ack(pkt.seq_no)
+
+            # deliver whatever is now in order
+            for ready in recv_window.pop_ready():
+                self._deliver(transfer, ready)
+                if transfer['status'] is not None:
+                    break
+        return self._transfer_status(transfer)
+
+    def _next_packet(self, client_sock, filename, pieces, started,
+                     download=None):
+        '''
+        Function to wait for the next packet of a transfer, returns None if
+        none came in time
+        param client_sock : UDP client connected to the peer
+        param filename : name/number of the file requested
+        param pieces : first piece and number of pieces requested
+        param started : whether anything was received from the peer yet
+        param download : Download tracking progress and cancellation, if any
+        '''
+        try:
+            # try to get data from socket, ask again sooner while the
+            # request may have been lost
+            if started:
+                return client_sock.recv()
+            return client_sock.recv(constants.CLIENT_REQUEST_RETRIES)
+        except ConnectionError:
+            # request packet may have been lost, ask again
+            if not started:
+                client_sock.send_request(filename, pieces)
+                if download is not None:
+                    download.add_retry()
+            return None
+
+    def _transfer_status(self, transfer):
+        '''
+        Function to get the status, the hash of the file and the piece
+        checker of a transfer that ended
+        param transfer : state of the transfer
+        '''
+        status = transfer['status']
+        if status not in ('closed', 'cancelled', 'changed'):
+            # connection to main server lost
+            if (not self.serv_conn.get_conn_status()):
+                status = 'lost'
+            # connection ended, or retries expired
+            elif status != 'done':
+                status = 'failed'
+        return status, transfer['hash'], transfer['checker']
+
+    def _deliver(self, transfer, ready):
+        '''
+        Function to handle a packet of a transfer delivered in order
+        param transfer : state of the transfer
+        param ready : decoded Packet delivered
+        '''
+        if not transfer['got_hash']:
+            transfer['got_hash'] = True
+            self._receive_manifest(transfer, ready)
+            return
+        if ready.type == constants.PIECE_HASH_PACKET:
+            transfer['checker'].add_hashes(ready.offset, ready.payload)
+            return
+        self._receive_block(transfer, ready)
+        # last packet by server
+        if (ready.type == constants.SERVER_END_PACKET):
+            transfer['status'] = 'done'
+
+    def _receive_manifest(self, transfer, ready):
+        '''
+        Function to handle the first packet of a transfer, the hash of the
+        file from a legacy peer and the manifest of the file otherwise
+        param transfer : state of the transfer
+        param ready : decoded Packet delivered
+        '''
+        if transfer['legacy']:
+            # file empty
+            if ready.type == constants.SERVER_END_PACKET:
+                transfer['status'] = 'done'
+            else:
+                transfer['hash'] = ready.payload.decode(encoding='utf-8')
+            return
+        try:
+            manifest = decode_manifest(ready.payload)
+        except ValueError as e:
+            logger.error(f"Bad manifest from peer: {e}")
+            transfer['status'] = 'failed'
+            return
+        transfer['hash'] = manifest.file_hash
+        writer = transfer['writer']
+        writer.preallocate(manifest.file_size)
+        if transfer['download'] is not None:
+            transfer['download'].size = manifest.file_size
+        if transfer['checker'] is None:
+            transfer['checker'] = PieceChecker(manifest)
+            # a crash leaves the file marked as partial
+            save_progress(transfer['checker'], writer.get_filepath())
+        # file changed on the peer since the first transfer
+        elif manifest != transfer['checker'].manifest:
+            logger.error(f"File {transfer['filename']} changed on peer")
+            transfer['status'] = 'changed'
+
+    def _receive_block(self, transfer, ready):
+        '''
+        Function to write a block of the file and feed it to the piece
+        checker. The parts of a compressed piece are gathered until the last
+        one and written once the piece is decompressed
+        param transfer : state of the transfer
+        param ready : decoded Packet delivered
+        '''
+        checker = transfer['checker']
+        block, offset = ready.payload, ready.offset
+        codec = packet.codec_of(ready.flags)
+        if codec != compress.NONE and checker is not None:
+            offset -= offset % checker.manifest.piece_size
+            if ready.offset == offset:
+                transfer['packed'] = bytearray()
+            transfer['packed'].extend(ready.payload)
+            block = None
+            if ready.flags & constants.FLAG_PIECE_END:
+                block = self._unpack_piece(codec, transfer['packed'], offset,
+                                           checker)
+        # the legacy format carries no offset, blocks come in order
+        if block is None:
+            return
+        transfer['writer'].write(block, offset)
+        if transfer['download'] is not None:
+            transfer['download'].add_progress(len(block))
+        if checker is not None:
+            checker.feed(block, offset)
+
+    def _unpack_piece(self, codec, packed, offset, checker):
+        '''
+        Function to decompress a piece, returns None if it is broken. The
+        piece is then missing and fetched again
+        param codec : codec the piece was compressed with
+        param packed : compressed bytes of the piece
+        param offset : offset of the piece in the file
+        param checker : piece checker of the file
+        '''
+        index = offset // checker.manifest.piece_size
+        try:
+            return compress.decompress(codec, bytes(packed),
+                                       checker.piece_length(index))
+        except ValueError as e:
+            logger.error(f"Piece {index} not decompressed: {e}")
+            return None
+
+    def run_batch(self, manifest, summary):
+        '''
+        Function to download the files of a manifest without a prompt. Writes
+        a summary with the latency, bytes and retries of every file and
+        closes the client once they are all done
+        param manifest : file numbers to download, or batch.MISSING
+        param summary : where to write the summary, - for stdout
+        '''
+        started = time.monotonic()
+        file_nos = manifest
+        if manifest == batch.MISSING:
+            file_nos = batch.missing_files(self.file_vector, self.down_loca)
+        logger.info(f"Batch run of {len(file_nos)} files")
+        results = self.queue_files(file_nos) if len(file_nos) > 0 else {}
+        for download in (results or {}).values():
+            download.wait()
+        report = batch.summarize(self.client_id, file_nos, results,
+                                 time.monotonic() - started)
+        batch.write_summary(report, summary)
+        self.batch_ok = results is not None and report['failed'] == 0
+        self.client_shutdown = True
+        self.serv_conn.set_close()
 
     def user_input(self):
         '''
@@ -349,16 +625,41 @@ class Client():
         while(not self.client_shutdown and self.serv_conn.get_conn_status()):
             os.system('cls' if os.name == 'nt' else 'clear')
             try:
-                file_name = inputimeout(prompt="Please enter file to download"
+                file_name = inputimeout(prompt="Please enter file to download,"
+                                        " s for the status of downloads,"
+                                        " c <file> to cancel a download"
                                         " or -1 to exit client \n>>",
                                         timeout=30.0).strip()
             except TimeoutOccurred:
                 continue
+            # status of the downloads of this session
+            if file_name == 's':
+                downloads = self.downloads.status()
+                for download in downloads:
+                    print(download)
+                if len(downloads) == 0:
+                    print("No downloads yet")
+                time.sleep(5.0)
+                continue
+            # cancel a download
+            if file_name[:2] == 'c ':
+                try:
+                    file_no = int(file_name[2:].strip()[:-4])
+                except ValueError:
+                    print("Invalid input entered")
+                    time.sleep(5.0)
+                    continue
+                if self.downloads.cancel(file_no):
+                    print(f"Cancelling download of {file_no}.txt")
+                else:
+                    print(f"No download of {file_no}.txt in progress")
+                time.sleep(5.0)
+                continue
             if (len(file_name) == 2):
                 try:
                     if int(file_name) == -1:
-                        self.serv_conn.set_close()
                         self.client_shutdown = True
+                        self.serv_conn.set_close()
                         return
                     else:
                         print("Invalid input entered")
@@ -367,7 +668,7 @@ class Client():
                     print("Invalid input entered")
                     time.sleep(5.0)
                     continue
-            if file_name[-4:] == '.txt':
+            if ',' not in file_name and file_name[-4:] == '.txt':
                 try:
                     file_no = int(file_name[:-4])
                 except ValueError:
@@ -376,36 +677,142 @@ class Client():
                     continue
 
                 if self.serv_conn.get_conn_status():
-                    port, client_id = self.serv_conn.request_file(file_no)
-                    if (port == -2):
-                        continue
-                    if (int(port) == self.my_port):
-                        print("Requesting from myself...")
-                        # continue
-                    if (int(port) == -1):
-                        print("No peers have file")
-                        time.sleep(5.0)
+                    # the peers are looked up when a worker starts it
+                    self.downloads.submit(file_no)
+                    print(f"Download of {file_name} queued, enter s for its"
+                          " progress")
+                    time.sleep(5.0)
+            # many files separated by commas
+            elif ',' in file_name:
+                try:
+                    file_nos = [int(name.strip()[:-4])
+                                for name in file_name.split(',')
+                                if name.strip()[-4:] == '.txt']
+                except ValueError:
+                    print("Invalid input entered")
+                    time.sleep(5.0)
+                    continue
+                if self.serv_conn.get_conn_status():
+                    downloads = self.queue_files(file_nos)
+                    if downloads is None:
                         continue
-                    success = self.request_file(file_name[:-4],
-                                                (socket.gethostbyname(
-                                                    socket.gethostname()
-                                                ),
-                                                int(port)),
-                                                self.client_file_mgr.newWrite(
-                                                    self.down_loca
-                                                    / (file_name[:-4] + '.txt')
-                                                ))
-                    if not success:
-                        logger.error(f"Request for {file_name} from "
-                                     f"{port} failed.")
-                        print("Request failed, check logs for info.")
-                        time.sleep(5.0)
-                    else:
-                        logger.info(f"Request for {file_name} from {client_id}"
-                                    " completed successfully.")
-                        print(f"Request for file {file_name} completed"
-                              " successfully")
-                        time.sleep(5.0)
+                    print(f"Queued {len(downloads)} of {len(file_nos)} files,"
+                          " enter s for their progress")
+                    time.sleep(5.0)
+
+    def _lookup_peers(self, file_no):
+        '''
+        Function to get the peers holding a file from the main server. Returns
+        a list of (port, client id) or -2 if the connection is lost
+        param file_no : number of the file
+        '''
+        peers = self.serv_conn.request_peers(file_no)
+        # main server does not know swarms, ask for one peer
+        if (peers == -1):
+            port, client_id = self.serv_conn.request_file(file_no)
+            if (port == -2):
+                return -2
+            peers = [] if int(port) == -1 else [(port, client_id)]
+        return peers
+
+    def fetch(self, download):
+        '''
+        Function run by the download manager for each download, looks up the
+        peers holding the file if needed and downloads it. Returns whether
+        the file was downloaded
+        param download : Download to run
+        '''
+        peers = download.peers
+        if peers is None:
+            peers = self._lookup_peers(download.file_no)
+            if (peers == -2):
+                return False
+        if (len(peers) == 0):
+            logger.error(f"No peers have file {download.file_no}")
+            return False
+        return self.download_file(download.file_no, peers, download)
+
+    def download_file(self, file_no, peers, download=None):
+        '''
+        Function to download a file from the peers holding it, from several
+        at once if there are more, and report the result to the main server
+        param file_no : number of the file
+        param peers : list of (port, client id) of the peers holding the file
+        param download : Download tracking progress and cancellation, if any
+        '''
+        file_name = f"{file_no}.txt"
+        if any(int(port) == self.my_port for port, _ in peers):
+            print("Requesting from myself...")
+        port = ",".join(port for port, _ in peers)
+        client_id = ",".join(client_id for _, client_id in peers)
+        addrs = [(socket.gethostbyname(socket.gethostname()),
+                  int(peer_port)) for peer_port, _ in peers]
+        # pieces verified by an earlier download are not fetched again
+        checker = load_progress(self.down_loca / file_name)
+        if checker is not None and checker.complete():
+            checker = None
+        if checker is not None:
+            logger.info(f"Resuming {file_name}, {len(checker.missing())} of "
+                        f"{checker.manifest.piece_count} pieces missing")
+        writer = self.client_file_mgr.newWrite(self.down_loca / file_name,
+                                               checker is not None)
+        if len(addrs) == 1:
+            success = self.request_file(str(file_no), addrs[0], writer,
+                                        download, checker)
+        else:
+            success = self.swarm_file(str(file_no), addrs, writer, download,
+                                      checker)
+        del writer
+        # let the main server know the peers are free again
+        if not success:
+            self.serv_conn.send_failure(file_no, client_id)
+            logger.error(f"Request for {file_name} from {port} failed.")
+        else:
+            self.serv_conn.send_success(file_no, client_id)
+            logger.info(f"Request for {file_name} from {client_id}"
+                        " completed successfully.")
+        return success
+
+    def release(self, file_no, peers):
+        '''
+        Function to let the main server know the peers looked up for a
+        download that does not run are free again, it counts an upload
+        against every peer it returns
+        param file_no : number of the file
+        param peers : list of (port, client id) of the peers
+        '''
+        if len(peers) > 0:
+            self.serv_conn.send_failure(
+                file_no, ",".join(client_id for _, client_id in peers))
+
+    def queue_files(self, file_nos):
+        '''
+        Function to queue the downloads of many files, looked up with a
+        single request to the main server. Files with the fewest holders are
+        queued first. Returns a dictionary of file number to its Download,
+        None if the connection is lost
+        param file_nos : numbers of the files
+        '''
+        files = self.serv_conn.request_files(file_nos)
+        if (files == -2):
+            return None
+        # main server does not know batches, look the files up one by one
+        if (files == -1):
+            files = {}
+            for file_no in file_nos:
+                peers = self._lookup_peers(file_no)
+                if (peers == -2):
+                    return None
+                files[file_no] = peers
+        for file_no in file_nos:
+            if len(files.get(file_no, [])) == 0:
+                logger.error(f"No peers have file {file_no}")
+        # rarest first, they are the most likely to disappear
+        plan = sorted((file_no for file_no in files.keys()
+                       if len(files[file_no]) > 0),
+                      key=lambda file_no: len(files[file_no]))
+        return {file_no: self.downloads.submit(file_no, files[file_no])
+                for file_no in plan}
 
     def __del__(self):
         pass
@@ -414,6 +821,20 @@ class Client():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Client instance")
     parser.add_argument('client_no', metavar='C', type=int)
+    # batch runs download without a prompt and exit with a summary
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--manifest', metavar='PATH',
+                        help="download the files listed in PATH (- for "
+                        "stdin) without a prompt")
+    source.add_argument('--missing', action='store_true',
+                        help="download every file the client does not have "
+                        "without a prompt")
+    parser.add_argument('--parallel', type=int,
+                        default=constants.CLIENT_BULK_DOWNLOADS,
+                        help="files downloaded at once")
+    parser.add_argument('--summary', metavar='PATH', default='-',
+                        help="where a batch run writes its JSON summary, "
+                        "- for stdout")
     args = parser.parse_args()
     # print(args.client_no)
     # input()
@@ -423,4 +844,17 @@ if __name__ == "__main__":
                         format="%(asctime)s :: %(pathname)s:%(lineno)d ::"
                         " %(levelname)s :: %(message)s",
                         filename=f"./client_logs/log_{client_no}.log")
-    client = Client(f'./configs/clients/{client_no}/{client_no}.yaml')
+    manifest = None
+    if args.manifest is not None or args.missing:
+        batch.quiet_stdout()
+    if args.manifest is not None:
+        try:
+            manifest = batch.read_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            parser.error(f"bad manifest {args.manifest}: {e}")
+    elif args.missing:
+        manifest = batch.MISSING
+    client = Client(f'./configs/clients/{client_no}/{client_no}.yaml',
+                    manifest, args.parallel, args.summary)
+    if client.batch_ok is not None:
+        sys.exit(0 if client.batch_ok else 1)
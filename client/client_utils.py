@@ -1,6 +1,15 @@
+import os
+import mmap
+import hashlib
 import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import yaml
+import compress
 import constants
-from utils import file_hash
+from utils import file_hashes, verify_hash
+from pieces import encode_manifest, encode_hashes, piece_count
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -25,6 +34,101 @@ class ClientFile():
                 if not Path(file_i_location).is_file():
                     raise FileNotFoundError
                 self.filedict[i] = file_i_location
+        # hashes of the files kept across requests and restarts
+        self.cache_loc = Path(file_location)/constants.HASH_CACHE_FILE
+        self.cache_lock = threading.Lock()
+        self.hash_cache = self._load_cache()
+        self.cache_dirty = False  # hashes computed and not saved yet
+        # files mapped into memory, shared by every request for the file
+        self.maps = {}
+        self.maps_lock = threading.Lock()
+        # compresses pieces outside the threads serving transfers
+        self.compressor = ThreadPoolExecutor(constants.COMPRESS_WORKERS)
+
+    def _load_cache(self):
+        '''
+        Function to load the hash cache of the client, a missing or broken
+        cache is started over
+        '''
+        if not self.cache_loc.is_file():
+            return {}
+        try:
+            with open(self.cache_loc, 'r') as f:
+                cache = yaml.load(f, Loader=yaml.SafeLoader)
+        except (OSError, yaml.YAMLError) as e:
+            logger.warning(f"Hash cache {self.cache_loc} not loaded: {e}")
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        return cache
+
+    def _save_cache(self):
+        '''
+        Function to write the hash cache of the client, replaces the old
+        cache in one step so a crash never leaves half a cache behind. Must
+        be called with cache_lock held
+        '''
+        tmp_loc = self.cache_loc.with_name(self.cache_loc.name + '.tmp')
+        try:
+            with open(tmp_loc, 'w') as f:
+                yaml.dump(self.hash_cache, f, Dumper=yaml.SafeDumper)
+            os.replace(tmp_loc, self.cache_loc)
+            self.cache_dirty = False
+        except OSError as e:
+            logger.warning(f"Hash cache {self.cache_loc} not saved: {e}")
+
+    def saveCache(self):
+        '''
+        Function to write the hash cache if hashes were computed since it was
+        last written, called once hashAll is done and on shutdown
+        '''
+        with self.cache_lock:
+            if self.cache_dirty:
+                self._save_cache()
+
+    def cachedHashes(self, i, stat=None):
+        '''
+        Function to get the hashes of a file from the cache, None if the
+        file is not cached or changed since it was hashed
+        param i : file number in vector
+        param stat : stat of the file, taken if not given
+        '''
+        path = self.filedict[i]
+        if stat is None:
+            stat = Path(path).stat()
+        with self.cache_lock:
+            entry = self.hash_cache.get(str(path))
+            if entry is not None and entry['size'] == stat.st_size and \
+                    entry['mtime'] == stat.st_mtime_ns and \
+                    entry['piece_size'] == constants.PIECE_SIZE:
+                return (entry['hash'],
+                        [bytes.fromhex(h) for h in entry['pieces']])
+        return None
+
+    def getHashes(self, i):
+        '''
+        Function to get the sha1 hash of a file and the digests of its
+        pieces. Hashes are cached by path, size and modification time and
+        only computed again when the file changed. New hashes are written to
+        disk by saveCache
+        param i : file number in vector
+        '''
+        path = self.filedict[i]
+        stat = Path(path).stat()
+        key = str(path)
+        hashes = self.cachedHashes(i, stat)
+        if hashes is not None:
+            return hashes
+
+        hash, pieces = file_hashes(path, constants.PIECE_SIZE)
+        with self.cache_lock:
+            self.hash_cache[key] = {'size': stat.st_size,
+                                    'mtime': stat.st_mtime_ns,
+                                    'piece_size': constants.PIECE_SIZE,
+                                    'hash': hash,
+                                    'pieces': [h.hex() for h in pieces]}
+            self.cache_dirty = True
+        return hash, pieces
 
     def checkFile(self, i):
         '''
@@ -35,38 +139,123 @@ class ClientFile():
             return True
         return False
 
-    def newRead(self, i):
+    def hashAll(self):
+        '''
+        Function to fill the hash cache for every file of the client, run at
+        startup so requests do not wait on hashing
+        '''
+        for i in self.filedict.keys():
+            try:
+                self.getHashes(i)
+            except OSError as e:
+                logger.error(f"Failed to hash file {i}: {e}")
+        # one write for every file hashed
+        self.saveCache()
+
+    def getMapped(self, i):
+        '''
+        Function to get the memory map of a file. A file is mapped once and
+        the map is shared by all its requests, it is mapped again only once
+        the file changed. Requests still reading an old map keep it alive
+        param i : file number in vector
+        '''
+        path = self.filedict[i]
+        stat = Path(path).stat()
+        with self.maps_lock:
+            mapped = self.maps.get(i)
+            if mapped is None or mapped.changed(stat):
+                mapped = MappedFile(path)
+                self.maps[i] = mapped
+            return mapped
+
+    def newRead(self, i, payload_size=constants.DATA_PAYLOAD_SIZE,
+                pieces=None, codec=compress.NONE):
         '''
         Function to return new read object for a file
         param i : file number in vector
+        param payload_size : number of bytes to read at a time
+        param pieces : first piece and number of pieces (0 for all) to read,
+                       None to send only the file hash to a legacy peer
+        param codec : codec to compress the pieces with, they are compressed
+                      by the workers of the client
         '''
-        return ReadObj(self.filedict[i]).read()
+        return ReadObj(self.filedict[i], self.getHashes(i),
+                       self.getMapped(i), self.compressor).read(
+                           payload_size, pieces, codec)
 
-    def newWrite(self, loc):
+    def newWrite(self, loc, resume=False):
         '''
         Function to return new write object for a file
         param loc : location to create a file and write to it
+        param resume : whether to keep what the file holds, to resume a
+                       download
         '''
-        return WriteObj(loc)
+        return WriteObj(loc, resume)
+
+
+class MappedFile():
+    '''
+    Class for a file mapped read only into memory. Blocks are handed out as
+    memoryview slices of the map, so they are never copied before they are
+    put into a packet
+    '''
+    def __init__(self, file_location):
+        '''
+        Constructor for a mapped file
+        param file_location : path of the file to map
+        '''
+        stat = Path(file_location).stat()
+        self.mtime = stat.st_mtime_ns
+        # (codec, offset) of the pieces that do not shrink, they are sent as
+        # they are without compressing them again
+        self.incompressible = set()
+        self.view = memoryview(b'')
+        # an empty file cannot be mapped
+        if stat.st_size > 0:
+            with open(file_location, 'rb') as f:
+                self.view = memoryview(mmap.mmap(f.fileno(), 0,
+                                                 access=mmap.ACCESS_READ))
+        self.size = len(self.view)
+
+    def changed(self, stat):
+        '''
+        Function to check whether the file changed since it was mapped
+        param stat : current stat result of the file
+        '''
+        return stat.st_size != self.size or stat.st_mtime_ns != self.mtime
 
 
 class ReadObj():
     '''
     Class for a file read object
     '''
-    def __init__(self, file_location):
+    def __init__(self, file_location, hashes=None, mapped=None,
+                 compressor=None):
         '''
         Constructor for read object class
         param file_location : path of the file to read
+        param hashes : sha1 hash and piece digests of the file, None to
+                       compute them
+        param mapped : MappedFile of the file, None to map it
+        param compressor : executor compressing pieces ahead of the reader,
+                           None to compress them as they are read
         '''
+        self.file_loc = file_location
+        if mapped is None:
+            mapped = MappedFile(file_location)
+        self.view = mapped.view
+        self.file_size = mapped.size
+        self.incompressible = mapped.incompressible
+        self.compressor = compressor
         # empty file
-        if (Path(file_location).stat().st_size == 0):
+        if (self.file_size == 0):
             self.file_hash = None
             return
-        self.file_obj = open(file_location, 'rb')
         # get hash of the file
-        self.file_hash = bytes(file_hash(file_location), encoding='utf-8')
-        self.file_loc = file_location
+        if hashes is None:
+            hashes = file_hashes(file_location, constants.PIECE_SIZE)
+        self.file_hash = bytes(hashes[0], encoding='utf-8')
+        self.piece_hashes = hashes[1]
 
     def get_filepath(self):
         '''
@@ -74,42 +263,172 @@ class ReadObj():
         '''
         return self.file_loc
 
-    def read(self):
+    def read(self, payload_size=constants.DATA_PAYLOAD_SIZE, pieces=None,
+             codec=compress.NONE):
         '''
-        Function to read from a file DATA_PAYLOAD_SIZE bytes at a time
+        Function to read from a file payload_size bytes at a time. Yields the
+        block, its packet type, its offset in the file and its packet flags
+        param payload_size : number of bytes to read at a time
+        param pieces : first piece and number of pieces (0 for all) to read,
+                       None to send only the file hash to a legacy peer
+        param codec : codec to compress the pieces with
         '''
+        if pieces is not None:
+            yield from self.read_pieces(payload_size, *pieces, codec)
+            return
         # if file is not empty
         if (self.file_hash is not None):
             # yield file hash first
-            yield (self.file_hash, constants.DATA_PACKET)
-            while (block := self.file_obj.read(constants.DATA_PAYLOAD_SIZE)):
-                if len(block) < constants.DATA_PAYLOAD_SIZE:
-                    yield (block, constants.SERVER_END_PACKET)
+            yield (self.file_hash, constants.DATA_PACKET, 0, 0)
+            offset = 0
+            while True:
+                block = self.view[offset:offset + payload_size]
+                # a short (or empty) block is the last one
+                if len(block) < payload_size:
+                    yield (block, constants.SERVER_END_PACKET, offset, 0)
                     break
-                yield (block, constants.DATA_PACKET)
+                yield (block, constants.DATA_PACKET, offset, 0)
+                offset += len(block)
         # yield an empty bytes object
         else:
-            yield (b'', constants.SERVER_END_PACKET)
+            yield (b'', constants.SERVER_END_PACKET, 0, 0)
 
-    def __del__(self):
+    def read_pieces(self, payload_size, first, count, codec=compress.NONE):
         '''
-        Destructor for file read object, closes the file after done reading
+        Function to read a range of pieces payload_size bytes at a time. The
+        manifest and the hashes of the pieces are yielded before the data
+        param payload_size : number of bytes to read at a time
+        param first : index of the first piece to read
+        param count : number of pieces to read, 0 to read to the end
+        param codec : codec to compress the pieces with
         '''
-        if (self.file_hash is not None):
-            self.file_obj.close()
+        yield (encode_manifest(constants.PIECE_SIZE, self.file_size,
+                               self.file_hash), constants.DATA_PACKET, 0, 0)
+        # empty file
+        if (self.file_hash is None):
+            yield (b'', constants.SERVER_END_PACKET, 0, 0)
+            return
+        total = piece_count(self.file_size)
+        first = min(first, total)
+        last = total if count == 0 else min(total, first + count)
+        hashes = self.piece_hashes[first:last]
+        for block, index in encode_hashes(hashes, first, payload_size):
+            yield (block, constants.PIECE_HASH_PACKET, index, 0)
+
+        offset = first * constants.PIECE_SIZE
+        end = min(last * constants.PIECE_SIZE, self.file_size)
+        if codec != compress.NONE and offset < end:
+            starts = range(offset, end, constants.PIECE_SIZE)
+            packing = deque()  # compressions of the next pieces, in order
+            for n, start in enumerate(starts):
+                while len(packing) <= constants.COMPRESS_AHEAD and \
+                        n + len(packing) < len(starts):
+                    packing.append(self._pack(starts[n + len(packing)], end,
+                                              codec))
+                job = packing.popleft()
+                while not job.done():
+                    yield (job, constants.READ_PENDING, start, 0)
+                yield from self._read_compressed(payload_size, start, end,
+                                                 codec, job.result())
+            return
+        while True:
+            block = self.view[offset:min(offset + payload_size, end)]
+            # the block reaching the end of the range is the last one
+            if len(block) == 0 or offset + len(block) >= end:
+                yield (block, constants.SERVER_END_PACKET, offset, 0)
+                break
+            yield (block, constants.DATA_PACKET, offset, 0)
+            offset += len(block)
+
+    def _pack(self, start, end, codec):
+        '''
+        Function to start compressing a piece, on the compressor if there is
+        one. Returns a Future of the compressed piece, None if it does not
+        shrink
+        param start : offset of the piece
+        param end : offset of the end of the range read
+        param codec : codec to compress the piece with
+        '''
+        if self.compressor is not None and \
+                (codec, start) not in self.incompressible:
+            return self.compressor.submit(self._compress, start, end, codec)
+        job = Future()
+        job.set_result(self._compress(start, end, codec))
+        return job
+
+    def _compress(self, start, end, codec):
+        '''
+        Function to compress a piece, returns None if it does not shrink. The
+        pieces that do not shrink are remembered for the file
+        param start : offset of the piece
+        param end : offset of the end of the range read
+        param codec : codec to compress the piece with
+        '''
+        if (codec, start) in self.incompressible:
+            return None
+        data = self.view[start:min(start + constants.PIECE_SIZE, end)]
+        packed = compress.compress(codec, data)
+        if len(packed) < len(data):
+            return packed
+        self.incompressible.add((codec, start))
+        return None
+
+    def _read_compressed(self, payload_size, start, end, codec, packed):
+        '''
+        Function to read a piece compressed, payload_size bytes at a time. A
+        piece that does not shrink is read as it is
+        param payload_size : number of bytes to read at a time
+        param start : offset of the piece
+        param end : offset of the end of the range read
+        param codec : codec the piece was compressed with
+        param packed : bytes of the compressed piece, None if it does not
+                       shrink
+        '''
+        piece_end = min(start + constants.PIECE_SIZE, end)
+        data, flags = self.view[start:piece_end], 0
+        if packed is not None:
+            data = memoryview(packed)
+            flags = codec << constants.FLAG_CODEC_SHIFT
+        for position in range(0, len(data), payload_size):
+            block = data[position:position + payload_size]
+            pkt_type = constants.DATA_PACKET
+            pkt_flags = flags
+            if position + len(block) >= len(data):
+                if piece_end >= end:
+                    pkt_type = constants.SERVER_END_PACKET
+                if flags != 0:
+                    pkt_flags |= constants.FLAG_PIECE_END
+            yield (block, pkt_type, start + position, pkt_flags)
 
 
 class WriteObj():
     '''
-    Class for a file write object. Keeps track of current position
+    Class for a file write object. Blocks are written at their offset with
+    positional writes, blocks that follow each other are gathered in memory
+    and written together. Blocks written in order are hashed as they come
     '''
-    def __init__(self, file_location):
+    def __init__(self, file_location, resume=False):
         '''
         Constructor of file write object
         param file_location : location of file to write into
+        param resume : whether to keep what the file holds, to resume a
+                       download
         '''
-        self.file_obj = open(file_location, 'wb', 0)
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if not resume:
+            flags |= os.O_TRUNC
+        self.fd = os.open(file_location, flags, 0o666)
         self.file_loc = file_location
+        self.size = None  # size of the file, once it is preallocated
+        self.position = 0  # offset the next block is expected at
+        self.hasher = hashlib.sha1()
+        # every block so far followed the previous one, a resumed file holds
+        # blocks that were never hashed
+        self.in_order = not resume
+        # blocks not written yet, end offset -> (start offset, bytes)
+        self.runs = {}
+        # peers of a swarm download write to the file at once
+        self.lock = threading.Lock()
 
     def get_filepath(self):
         '''
@@ -117,15 +436,125 @@ class WriteObj():
         '''
         return self.file_loc
 
-    def write(self, block):
+    def preallocate(self, size):
+        '''
+        Function to reserve the disk space of the whole file once its size is
+        known, so blocks can be written anywhere without growing the file
+        param size : size of the file in bytes
+        '''
+        with self.lock:
+            if self.size is not None or size == 0:
+                return
+            self.size = size
+            try:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(self.fd, 0, size)
+                else:
+                    os.ftruncate(self.fd, size)
+            except OSError as e:
+                # the file then grows as it is written
+                logger.warning(f"Failed to preallocate {self.file_loc}: {e}")
+
+    def write(self, block, offset=None):
         '''
         Function to write a block of bytes into the file
         param block : block of bytes to write into the file
+        param offset : position in the file to write the block at, None to
+                       write after the previous block
+        '''
+        with self.lock:
+            if offset is None:
+                offset = self.position
+            elif offset != self.position:
+                # the running hash no longer matches the file
+                self.in_order = False
+            self.position = offset + len(block)
+            if self.in_order:
+                self.hasher.update(block)
+            self._buffer(block, offset)
+
+    def _buffer(self, block, offset):
+        '''
+        Function to add a block to the run of blocks it follows or start a
+        new run. Must be called with the lock held
+        param block : block of bytes to write into the file
+        param offset : position in the file to write the block at
+        '''
+        end = offset + len(block)
+        run = self.runs.pop(offset, None)
+        # bytes written again, the older ones have to reach the file first
+        for run_end, (start, _) in list(self.runs.items()):
+            if start < end and offset < run_end:
+                self._write_run(*self.runs.pop(run_end))
+        if run is None:
+            if len(self.runs) >= constants.WRITE_MAX_RUNS:
+                self._flush()
+            run = (offset, bytearray())
+        run[1].extend(block)
+        if len(run[1]) >= constants.WRITE_BUFFER_SIZE:
+            self._write_run(*run)
+        else:
+            self.runs[end] = run
+
+    def _write_run(self, offset, data):
+        '''
+        Function to write a run of blocks at its offset
+        param offset : position in the file of the run
+        param data : bytes of the run
+        '''
+        view = memoryview(data)
+        while len(view) > 0:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self.fd, view, offset)
+            else:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                written = os.write(self.fd, view)
+            view = view[written:]
+            offset += written
+
+    def _flush(self):
+        '''
+        Function to write every run not written yet. Must be called with the
+        lock held
+        '''
+        for offset, data in self.runs.values():
+            self._write_run(offset, data)
+        self.runs.clear()
+
+    def flush(self):
+        '''
+        Function to write every block not written yet to the file
+        '''
+        with self.lock:
+            self._flush()
+
+    def verify_hash(self, hash):
+        '''
+        Function to verify the hash of the file written. Uses the running
+        hash if all blocks were written in order, reads the file back
+        otherwise
+        param hash : expected sha1 of the file
+        '''
+        if self.in_order:
+            return self.hasher.hexdigest() == hash
+        logger.info(f"Blocks of {self.file_loc} written out of order, "
+                    "hashing the file from disk")
+        self.flush()
+        return verify_hash(hash, self.file_loc)
+
+    def close(self):
+        '''
+        Function to write the blocks not written yet and close the file
         '''
-        self.file_obj.write(block)
+        with self.lock:
+            if self.fd is None:
+                return
+            self._flush()
+            os.close(self.fd)
+            self.fd = None
 
     def __del__(self):
         '''
         Destructor of file write object, closes file after writing
         '''
-        self.file_obj.close()
+        self.close()
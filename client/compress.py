@@ -0,0 +1,120 @@
+import lzma
+import zlib
+import logging
+
+import constants
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+try:  # optional, pieces are only compressed with zstd if it is installed
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# codec ids, carried in requests as a bit mask and in packet flags
+NONE = 0
+ZLIB = 1
+LZMA = 2
+ZSTD = 3
+
+NAMES = {'zlib': ZLIB, 'lzma': LZMA, 'zstd': ZSTD}
+# fast levels, pieces are compressed while the window of a transfer is
+# loaded. Higher zlib levels take 8 times longer for 5% smaller pieces
+LEVELS = {ZLIB: 1, LZMA: 0, ZSTD: 3}
+# errors of broken compressed data
+ERRORS = (zlib.error, lzma.LZMAError)
+if zstandard is not None:
+    ERRORS += (zstandard.ZstdError,)
+
+
+def available(codec):
+    '''
+    Function to check whether a codec can be used on this client
+    param codec : codec id
+    '''
+    if codec == ZSTD:
+        return zstandard is not None
+    return codec in (ZLIB, LZMA)
+
+
+def preferred():
+    '''
+    Function to get the usable codecs of P2P_COMPRESSION, best first
+    '''
+    codecs = []
+    for name in constants.P2P_COMPRESSION:
+        codec = NAMES.get(name)
+        if codec is None:
+            logger.warning(f"Unknown compression codec {name}")
+        elif available(codec):
+            codecs.append(codec)
+    return codecs
+
+
+def offer():
+    '''
+    Function to get the bit mask of codecs a client accepts, sent in its
+    requests
+    '''
+    mask = 0
+    for codec in preferred():
+        mask |= 1 << codec
+    return mask
+
+
+def choose(mask):
+    '''
+    Function to pick the codec to serve a request with, the best codec
+    usable here that the client accepts. NONE if there is none
+    param mask : bit mask of codecs offered by the client
+    '''
+    for codec in preferred():
+        if mask & (1 << codec):
+            return codec
+    return NONE
+
+
+def compress(codec, data):
+    '''
+    Function to compress a piece
+    param codec : codec id
+    param data : bytes of the piece
+    '''
+    if codec == ZLIB:
+        return zlib.compress(data, LEVELS[ZLIB])
+    if codec == LZMA:
+        return lzma.compress(data, preset=LEVELS[LZMA])
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=LEVELS[ZSTD]).compress(data)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decompress(codec, data, max_size):
+    '''
+    Function to decompress a piece, raises ValueError if the data is broken
+    or holds more than a piece
+    param codec : codec id
+    param data : compressed bytes of the piece
+    param max_size : size of the piece
+    '''
+    try:
+        if codec == ZLIB:
+            decompressor = zlib.decompressobj()
+            piece = decompressor.decompress(data, max_size + 1)
+            complete = decompressor.eof
+        elif codec == LZMA:
+            decompressor = lzma.LZMADecompressor()
+            piece = decompressor.decompress(data, max_size + 1)
+            complete = decompressor.eof
+        elif codec == ZSTD and available(ZSTD):
+            piece = zstandard.ZstdDecompressor().decompress(
+                data, max_output_size=max_size + 1)
+            complete = True
+        else:
+            raise ValueError(f"Unknown codec {codec}")
+    except ERRORS as e:
+        raise ValueError(f"Broken piece: {e}")
+    if not complete or len(piece) > max_size:
+        raise ValueError("Piece does not decompress to its size")
+    return piece
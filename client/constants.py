@@ -1,5 +1,25 @@
-WINDOW_SIZE = 2
-MAX_SEQ_NO = 2*WINDOW_SIZE
+# packet format, the legacy format has a 1 byte sequence and type header
+PACKET_VERSION = 2
+LEGACY_PACKET_VERSION = 1
+# format used for requests, LEGACY_PACKET_VERSION to talk to old peers
+CLIENT_PACKET_VERSION = PACKET_VERSION
+HEADER_SIZE = 20
+LEGACY_HEADER_SIZE = 2
+FLAG_RETRANSMIT = 0x1
+# a compressed piece is sent split over data packets carrying its codec in
+# the flags, the last of them is marked. Their offset is the offset of the
+# piece plus the position in the compressed piece
+FLAG_PIECE_END = 0x2
+FLAG_CODEC_SHIFT = 8
+
+# window size requested by a client, negotiated down to MAX_WINDOW_SIZE
+WINDOW_SIZE = 256
+MAX_WINDOW_SIZE = 4096
+# selective repeat needs a sequence space of at least twice the window
+MAX_SEQ_NO = 2**32
+# old peers use a fixed window in a 1 byte sequence space
+LEGACY_WINDOW_SIZE = 2
+LEGACY_MAX_SEQ_NO = 2*LEGACY_WINDOW_SIZE
 
 SERVER_MAX_RETRIES = 10
 SERVER_RECV_TIMEOUT = 1.0
@@ -9,17 +29,88 @@ SERVER_END_PACKET = 2
 SERVER_END_ABNORMAL = 3
 SERVER_BUFFER_SIZE = 4096
 
+# 'threaded' serves peers from a blocking socket loop and a timer thread,
+# 'asyncio' from a single event loop
+P2P_SERVER_ENGINE = 'threaded'
+
+TIMER_WHEEL_TICK = 0.01
+TIMER_WHEEL_SLOTS = 512
+
+RTO_INITIAL = 1.0
+RTO_MIN = 0.05
+RTO_MAX = 10.0
+RTO_CLOCK_GRANULARITY = TIMER_WHEEL_TICK
+
 CLIENT_MAX_RETRIES = 10
 CLIENT_REQUEST_RETRIES = 2
 CLIENT_RECV_TIMEOUT = 0.4
 CLIENT_BUFFER_SIZE = 4096
+# on Linux, send runs of datagrams of one size in a single call
+# (UDP_SEGMENT) and receive datagrams coalesced by the kernel (UDP_GRO),
+# where the kernel supports it
+UDP_OFFLOAD = True
+UDP_GRO_BUFFER_SIZE = 2**16
+
+# workers of the download manager, files downloaded at once
+CLIENT_BULK_DOWNLOADS = 4
 
 CLIENT_MAIN_SERV_TIMEOUT = 5.0
+CLIENT_MAIN_SERV_MIN_TIMEOUT = 0.5
 CLIENT_MAIN_SERV_RETRIES = 10
 CLIENT_MAIN_SERV_HB_RETRIES = 4
+# offer length prefixed frames to the main server, requests then carry an
+# id so several can be in flight at once. Falls back to text messages
+CLIENT_MAIN_SERV_FRAMING = True
+# reconnects to a main server that went away, waiting twice as long before
+# each try up to the most delay. The client exits once they all fail
+CLIENT_MAIN_SERV_RECONNECT_TRIES = 6
+CLIENT_MAIN_SERV_RECONNECT_DELAY = 1.0
+CLIENT_MAIN_SERV_RECONNECT_MAX_DELAY = 16.0
+
+PACER_INITIAL_CWND = 10
+PACER_MIN_CWND = 2
+PACER_MAX_BURST = 8
+PACER_MIN_RTT = 0.001
+PACER_GAIN = 1.25
+PACER_GAIN_SLOW_START = 2.0
+# acks for this many later packets mark the oldest unacked one as lost
+FAST_RETRANSMIT_THRESHOLD = 3
 
-DATA_PAYLOAD_SIZE = CLIENT_BUFFER_SIZE - 2
+DATA_PAYLOAD_SIZE = CLIENT_BUFFER_SIZE - HEADER_SIZE
+LEGACY_DATA_PAYLOAD_SIZE = CLIENT_BUFFER_SIZE - LEGACY_HEADER_SIZE
 DATA_PACKET = 0
 DATA_ACK = 1
+# carries the piece hashes of a file, the offset is the first piece index
+PIECE_HASH_PACKET = 6
+
+# codecs offered in requests, best first, of 'zstd' (if installed), 'zlib'
+# and 'lzma'. The serving peer compresses each piece with the first codec
+# both know, pieces that do not shrink are sent as they are. Empty to turn
+# compression off
+P2P_COMPRESSION = ('zstd', 'zlib')
+# pieces are compressed by a pool of workers, the next pieces of a transfer
+# are compressed while its window is sent. A reader yields READ_PENDING
+# instead of a block while the piece it is at is still being compressed
+COMPRESS_WORKERS = 2
+COMPRESS_AHEAD = 2
+READ_PENDING = -1
+
+# files are verified in pieces, only failed pieces are fetched again
+PIECE_SIZE = 2**18
+PIECE_HASH_SIZE = 20
+CLIENT_PIECE_RETRIES = 3
+# a swarm download splits the file in chunks of pieces the peers take turns
+# on, faster peers come back for more chunks
+SWARM_CHUNK_PIECES = 4
+SWARM_MAX_PEERS = 8
+# blocks received one after the other are written to disk together, up to
+# this many bytes, from at most this many places in the file at once
+WRITE_BUFFER_SIZE = 2**18
+WRITE_MAX_RUNS = 16
+# sidecar file next to a partial download recording its verified pieces,
+# the download is resumed from it
+PROGRESS_SUFFIX = '.progress'
+# sidecar file next to the files of a client caching their hashes
+HASH_CACHE_FILE = '.hash_cache.yaml'
 
 END_CONNECTION_ACK = 4
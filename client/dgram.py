@@ -0,0 +1,182 @@
+import sys
+import errno
+import socket
+import struct
+import logging
+from collections import deque
+
+import constants
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# socket options of the Linux UDP offloads, not exported by every python
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+SEGMENT_SIZE = struct.Struct('=H')
+GRO_SIZE = struct.Struct('=i')
+# largest payload of an IPv4 UDP datagram and most segments the kernel
+# splits one send into
+MAX_DATAGRAM = 65507
+MAX_SEGMENTS = 64
+# errors of a kernel or device without segmentation offload
+NO_OFFLOAD = (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP)
+
+
+class DatagramIO():
+    '''
+    Class for the datagrams of a UDP socket, sent and received with as few
+    system calls and allocations as the platform allows. On Linux a run of
+    datagrams of the same size goes out in one send with UDP_SEGMENT,
+    gathered from their headers and payloads without joining them.
+    Datagrams coalesced by the kernel with UDP_GRO are received into one
+    reusable buffer and split again
+    '''
+    def __init__(self, sock, buffer_size=constants.CLIENT_BUFFER_SIZE,
+                 offload=constants.UDP_OFFLOAD):
+        '''
+        Constructor for the datagram I/O of a socket
+        param sock : UDP socket to send and receive on
+        param buffer_size : largest datagram received
+        param offload : whether to use the Linux UDP offloads if the kernel
+                        supports them
+        '''
+        self.sock = sock
+        self.buffer_size = buffer_size
+        linux = sys.platform.startswith('linux')
+        self.gso = offload and linux and hasattr(sock, 'sendmsg')
+        # receive offload is turned on by the first recv, so a socket only
+        # ever sent on, or handed to an event loop, never gets coalesced
+        # datagrams
+        self.gro = None if offload and linux else False
+        self.view = None
+        self.segments = deque()  # datagrams received and not returned yet
+        self.addr = None
+        self.sends = 0
+        self.sent = 0
+
+    def send(self, datagrams, addr):
+        '''
+        Function to send datagrams to an address, in order
+        param datagrams : list of (header, payload) of the datagrams
+        param addr : address to send to
+        '''
+        i = 0
+        while i < len(datagrams):
+            count = self._run(datagrams, i) if self.gso else 1
+            if count > 1 and self._send_segments(datagrams[i:i + count],
+                                                 addr):
+                i += count
+                continue
+            self._send_one(*datagrams[i], addr)
+            i += 1
+
+    def _run(self, datagrams, start):
+        '''
+        Function to get how many datagrams from start can be sent as the
+        segments of one send. All of them have the size of the first one
+        except the last, which may be shorter
+        param datagrams : list of (header, payload) of the datagrams
+        param start : index of the first datagram of the run
+        '''
+        size = len(datagrams[start][0]) + len(datagrams[start][1])
+        end = start + 1
+        while end < len(datagrams) and end - start < MAX_SEGMENTS and \
+                (end - start + 1) * size <= MAX_DATAGRAM:
+            length = len(datagrams[end][0]) + len(datagrams[end][1])
+            if length > size:
+                break
+            end += 1
+            if length < size:
+                break
+        return end - start
+
+    def _send_segments(self, datagrams, addr):
+        '''
+        Function to send datagrams in one call, split by the kernel. Returns
+        False if the kernel can not, segmentation offload is then turned off
+        param datagrams : list of (header, payload) of the datagrams
+        param addr : address to send to
+        '''
+        size = len(datagrams[0][0]) + len(datagrams[0][1])
+        parts = [part for datagram in datagrams for part in datagram]
+        try:
+            self.sock.sendmsg(parts, [(socket.IPPROTO_UDP, UDP_SEGMENT,
+                                       SEGMENT_SIZE.pack(size))], 0, addr)
+        except OSError as e:
+            if e.errno not in NO_OFFLOAD:
+                raise
+            logger.warning(f"UDP segmentation offload turned off: {e}")
+            self.gso = False
+            return False
+        self.sends += 1
+        self.sent += len(datagrams)
+        return True
+
+    def _send_one(self, header, payload, addr):
+        '''
+        Function to send a single datagram
+        param header : header of the datagram
+        param payload : payload of the datagram
+        param addr : address to send to
+        '''
+        # joining a few kilobytes costs less than building an iovec
+        self.sock.sendto(header + payload, addr)
+        self.sends += 1
+        self.sent += 1
+
+    def recv(self, keep=False):
+        '''
+        Function to receive a datagram, blocks as long as the timeout of the
+        socket and raises socket.timeout like recvfrom. Returns the datagram
+        and its address
+        param keep : whether the caller keeps the datagram, it is then
+                     returned as bytes. Otherwise it is a memoryview into the
+                     receive buffer, only valid until the next call
+        '''
+        if len(self.segments) == 0:
+            if self.view is None:
+                self._start_recv()
+            # a single datagram is copied out by recvfrom anyway
+            if keep and not self.gro:
+                return self.sock.recvfrom(self.buffer_size)
+            self._fill()
+        data = self.segments.popleft()
+        return (bytes(data) if keep else data), self.addr
+
+    def _fill(self):
+        '''
+        Function to receive into the buffer and split what was received into
+        its datagrams
+        '''
+        if self.gro:
+            nbytes, ancdata, _, self.addr = self.sock.recvmsg_into(
+                [self.view], socket.CMSG_SPACE(GRO_SIZE.size))
+            size = nbytes
+            for level, kind, data in ancdata:
+                if level == socket.IPPROTO_UDP and kind == UDP_GRO:
+                    size = GRO_SIZE.unpack(data[:GRO_SIZE.size])[0]
+        else:
+            nbytes, self.addr = self.sock.recvfrom_into(self.view)
+            size = nbytes
+        if nbytes == 0:  # an empty datagram is a datagram too
+            self.segments.append(self.view[:0])
+            return
+        size = size or nbytes
+        for start in range(0, nbytes, size):
+            self.segments.append(self.view[start:min(start + size, nbytes)])
+
+    def _start_recv(self):
+        '''
+        Function to turn on receive offload if the kernel supports it and
+        allocate the receive buffer, large enough for coalesced datagrams
+        '''
+        if self.gro is None:
+            try:
+                self.sock.setsockopt(socket.IPPROTO_UDP, UDP_GRO, 1)
+                self.gro = True
+            except OSError as e:
+                logger.info(f"UDP receive offload not available: {e}")
+                self.gro = False
+        size = constants.UDP_GRO_BUFFER_SIZE if self.gro else self.buffer_size
+        self.view = memoryview(bytearray(size))
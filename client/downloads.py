@@ -0,0 +1,202 @@
+import queue
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+import constants
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class Download():
+    '''
+    Class for the state of one download, shared by the manager, the worker
+    running it and the transfers of its peers
+    '''
+    def __init__(self, file_no, peers=None):
+        '''
+        Constructor for a download
+        param file_no : number of the file
+        param peers : list of (port, client id) of the peers holding the
+                      file, None to look them up when the download starts
+        '''
+        self.file_no = file_no
+        self.peers = peers
+        self.status = QUEUED
+        self.size = None  # known once a manifest arrives
+        self.received = 0
+        self.retries = 0  # requests sent again and pieces fetched again
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.ended_at = None
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+
+    def add_progress(self, nbytes):
+        '''
+        Function to count bytes written for the file, peers of a swarm add
+        to it at once
+        param nbytes : number of bytes written
+        '''
+        with self.lock:
+            self.received += nbytes
+
+    def add_retry(self):
+        '''
+        Function to count a request sent again or pieces fetched again
+        '''
+        with self.lock:
+            self.retries += 1
+
+    def cancel(self):
+        '''
+        Function to ask for the download to stop, its transfers notice it
+        between packets
+        '''
+        self.cancel_event.set()
+
+    def cancelled(self):
+        '''
+        Function to check whether the download was cancelled
+        '''
+        return self.cancel_event.is_set()
+
+    def finish(self, status):
+        '''
+        Function to set the final status of the download and wake waiters
+        param status : DONE, FAILED or CANCELLED
+        '''
+        self.ended_at = time.monotonic()
+        self.status = status
+        self.done_event.set()
+
+    def wait(self, timeout=None):
+        '''
+        Function to wait for the download to end, returns whether it was a
+        success
+        param timeout : seconds to wait, None to wait until it ends
+        '''
+        self.done_event.wait(timeout)
+        return self.status == DONE
+
+    def __str__(self):
+        progress = f"{self.received} bytes"
+        if self.size:
+            # pieces fetched again count twice, never show more than all
+            received = min(self.received, self.size)
+            progress = f"{received}/{self.size} bytes " \
+                       f"({100 * received // self.size}%)"
+        return f"{self.file_no}.txt: {self.status}, {progress}"
+
+
+class DownloadManager():
+    '''
+    Class running downloads on a bounded pool of worker threads fed by a
+    queue, so the prompt never waits for a transfer. Each worker runs one
+    download at a time with its own UDP clients and writer
+    '''
+    def __init__(self, client, workers=constants.CLIENT_BULK_DOWNLOADS):
+        '''
+        Constructor for the download manager
+        param client : Client the downloads are run for
+        param workers : number of files downloaded at once
+        '''
+        self.client = client
+        self.queue = queue.Queue()
+        self.downloads = OrderedDict()  # file number -> latest Download
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._work, daemon=True)
+                        for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, file_no, peers=None):
+        '''
+        Function to queue the download of a file, a file already queued or
+        running is not queued again and the peers given are released.
+        Returns its Download
+        param file_no : number of the file
+        param peers : list of (port, client id) of the peers holding the
+                      file, None to look them up when the download starts
+        '''
+        with self.lock:
+            download = self.downloads.get(file_no)
+            queued = download is not None and \
+                download.status in (QUEUED, RUNNING)
+            if not queued:
+                download = Download(file_no, peers)
+                self.downloads[file_no] = download
+                self.downloads.move_to_end(file_no)
+        if queued:
+            # the peers looked up for this request are not used
+            if peers is not None:
+                self.client.release(file_no, peers)
+            return download
+        self.queue.put(download)
+        return download
+
+    def cancel(self, file_no):
+        '''
+        Function to cancel a queued or running download, returns whether
+        there was one
+        param file_no : number of the file
+        '''
+        with self.lock:
+            download = self.downloads.get(file_no)
+        if download is None or download.status not in (QUEUED, RUNNING):
+            return False
+        download.cancel()
+        return True
+
+    def status(self):
+        '''
+        Function to get the downloads of this session, oldest first
+        '''
+        with self.lock:
+            return list(self.downloads.values())
+
+    def close(self):
+        '''
+        Function to cancel every download and stop the workers
+        '''
+        for download in self.status():
+            download.cancel()
+        for _ in self.workers:
+            self.queue.put(None)
+
+    def _work(self):
+        '''
+        Function run by each worker, takes downloads from the queue until
+        the manager is closed
+        '''
+        while True:
+            download = self.queue.get()
+            if download is None:
+                return
+            if download.cancelled():
+                if download.peers is not None:
+                    self.client.release(download.file_no, download.peers)
+                download.finish(CANCELLED)
+                continue
+            download.status = RUNNING
+            download.started_at = time.monotonic()
+            try:
+                success = self.client.fetch(download)
+            except Exception as e:  # a bug in one download keeps the worker
+                logger.exception(f"Download of {download.file_no} crashed: "
+                                 f"{e}")
+                success = False
+            if success:
+                download.finish(DONE)
+            else:
+                download.finish(CANCELLED if download.cancelled() else FAILED)
+            logger.info(f"Download finished, {download}")
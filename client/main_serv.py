@@ -2,9 +2,13 @@
 import socket
 import time
 import threading
+import itertools
+import contextlib
 import logging
 
 import constants
+import framing
+from rto import RTOEstimator
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -17,9 +21,29 @@ class MainServerConn():
         This class handles connection to the main server
         '''
         self.serv_port = server_port
+        self.config = config
         self.main_serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # set once the connection is lost or closed, the client sleeps on it
+        self.closed = threading.Event()
         self.set_conn_status(False)
+        # set while the main server has accepted the client, a lost
+        # connection is reestablished in the background until closing
+        self.online = threading.Event()
+        self.reconnect_lock = threading.Lock()
+        self.reconnecting = False
+        self.closing = False
         self.conn_estd = False
+        # framed messages, once the main server has accepted them
+        self.framed = False
+        self.offer_framing = False
+        self.frames = framing.FrameReader()
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request id -> [reply event, reply]
+        self.send_lock = threading.Lock()
+        # reply timeout, adapts to how fast the main server answers
+        self.rto = RTOEstimator(constants.CLIENT_MAIN_SERV_TIMEOUT,
+                                constants.CLIENT_MAIN_SERV_MIN_TIMEOUT,
+                                constants.CLIENT_MAIN_SERV_TIMEOUT)
         retries = 10
         while(retries):
             try:
@@ -39,29 +63,30 @@ class MainServerConn():
         self.send_init_to_serv(config)
 
         # a timer to send heartbeat packets
-        self.HB_timer = threading.Timer(10.0, self.send_HB)
-
         # waiting for HB packet response?
         self.wait_HB = threading.Lock()
-        self.HB_timer.start()
+        self._start_HB()
 
     def send_init_to_serv(self, config):
         '''
         Function to send init and handle init to server
         param config : config dictionary with information about client.
                        Keys are CLIENTID, FILE_VECTOR, MYPORT
+        Returns whether the main server accepted the client
         '''
-        self.main_serv.sendall(bytes("INIT:"+str(config['CLIENTID'])
-                                     + ":" + str(config['FILE_VECTOR'])
-                                     + ":" + str(config['MYPORT']),
-                                     encoding='utf-8'))  # send info to server
+        message = ("INIT:" + str(config['CLIENTID'])
+                   + ":" + str(config['FILE_VECTOR'])
+                   + ":" + str(config['MYPORT']))
+        # offer framed messages, a server without them answers in text
+        self.offer_framing = constants.CLIENT_MAIN_SERV_FRAMING
+        request_id = self._send(message)  # send info to server
+        sent_at = time.monotonic()
         # how many retries to receive back success message
         retries = constants.CLIENT_MAIN_SERV_RETRIES
         conn_estd = False
         while retries >= 0:
             try:
-                self.main_serv.settimeout(constants.CLIENT_MAIN_SERV_TIMEOUT)
-                success = self.main_serv.recv(4096)
+                success = self._recv_reply(sent_at, request_id)
                 # client init was a success
                 if success.decode('utf-8') == "Success!":
                     conn_estd = True
@@ -74,6 +99,12 @@ class MainServerConn():
                     break
                 # malformed request received by server
                 elif success.decode('utf-8') == "ERR:MALFORM":
+                    # the frame was not understood, introduce ourselves in text
+                    if self.offer_framing and not self.framed:
+                        self.offer_framing = False
+                        request_id = self._send(message)
+                        sent_at = time.monotonic()
+                        continue
                     conn_estd = False
                     logger.error("Server received malformed request."
                                  " init fail.")
@@ -88,10 +119,12 @@ class MainServerConn():
 
             except socket.timeout:  # socket time out
                 retries -= 1
+        self.offer_framing = False
         if (conn_estd):
             self.set_conn_status(True)
+            self.online.set()
             print("Got success")
-            return
+        return conn_estd
 
     def request_file(self, file_no):
         '''
@@ -99,129 +132,236 @@ class MainServerConn():
         param file_no : number of the file to retrieve
         '''
         # make sure we are not waiting for a HB reply
-        with self.wait_HB:
-            if (not self.get_conn_status()):  # connection is dead
+        with self._exclusive():
+            if (not self._wait_online()):  # connection is dead
                 return 0, -1
-            self.HB_timer.cancel()  # cancel HB timer
+            self._pause_HB()
             # send request to server
-            self.main_serv.sendall(bytes(f"FILE:{file_no}",
-                                         encoding="utf-8"))
+            request_id = self._send(f"FILE:{file_no}")
+            sent_at = time.monotonic()
             retries = constants.CLIENT_MAIN_SERV_RETRIES
             while retries >= 0:
                 try:
-                    self.main_serv.settimeout(
-                        constants.CLIENT_MAIN_SERV_TIMEOUT)
-
-                    resp = self.main_serv.recv(4096)
+                    resp = self._recv_reply(sent_at, request_id)
                     resp = resp.decode('utf-8')
                     try:
                         _, port, client_id = resp.split(':')
-                        self.HB_timer = threading.Timer(10.0, self.send_HB)
-                        self.HB_timer.start()
+                        self._resume_HB()
                         return port, client_id
                     except ValueError:
                         if resp == 'HB-' or len(resp) == 0:
-                            logger.info("server shutting down, client shutdown"
-                                        " initiated")
-                            self.set_conn_status(False)
+                            logger.info("server shutting down, reconnecting")
+                            self._lost()
                             return -2, -1
                         else:
                             logger.error("Unknown response received.")
                             return -1, -1
                 except socket.timeout:
                     retries -= 1
-            logger.info("server connection broken, client shutdown initiated")
-            self.set_close()
-            self.set_conn_status(False)
+            logger.info("server connection broken, reconnecting")
+            self._lost()
             return -2, -1
 
+    def request_peers(self, file_no, count=constants.SWARM_MAX_PEERS):
+        '''
+        Function to request the peers holding a file from the main server.
+        Returns a list of (port, client id), empty if no peer has the file,
+        -1 on an unknown reply and -2 if the connection is lost
+        param file_no : number of the file to retrieve
+        param count : most peers to get, the main server counts an upload
+                      against every peer it returns
+        '''
+        # make sure we are not waiting for a HB reply
+        with self._exclusive():
+            if (not self._wait_online()):  # connection is dead
+                return -2
+            self._pause_HB()
+            # send request to server
+            request_id = self._send(f"PEERS:{file_no}:{count}")
+            sent_at = time.monotonic()
+            retries = constants.CLIENT_MAIN_SERV_RETRIES
+            while retries >= 0:
+                try:
+                    resp = self._recv_reply(sent_at, request_id)
+                    resp = resp.decode('utf-8')
+                    if resp == 'HB-' or len(resp) == 0:
+                        logger.info("server shutting down, reconnecting")
+                        self._lost()
+                        return -2
+                    self._resume_HB()
+                    try:
+                        kind, peers = resp.split(':')
+                        if kind != 'PEERS':
+                            raise ValueError(resp)
+                        if peers == '-1':  # no peer has the file
+                            return []
+                        return [tuple(peer.split(','))
+                                for peer in peers.split(';')]
+                    except ValueError:
+                        logger.error("Unknown response received.")
+                        return -1
+                except socket.timeout:
+                    retries -= 1
+            logger.info("server connection broken, reconnecting")
+            self._lost()
+            return -2
+
+    def request_files(self, file_nos, count=constants.SWARM_MAX_PEERS):
+        '''
+        Function to request the peers holding each of many files from the
+        main server in one round trip. Returns a dictionary of file number
+        to a list of (port, client id), empty if no peer has the file, -1 on
+        an unknown reply and -2 if the connection is lost
+        param file_nos : numbers of the files to retrieve
+        param count : most peers to get per file, the main server counts an
+                      upload against every peer it returns
+        '''
+        # make sure we are not waiting for a HB reply
+        with self._exclusive():
+            if (not self._wait_online()):  # connection is dead
+                return -2
+            self._pause_HB()
+            # send request to server
+            request_id = self._send(
+                "FILES:" + ",".join(str(i) for i in file_nos) + f":{count}")
+            sent_at = time.monotonic()
+            retries = constants.CLIENT_MAIN_SERV_RETRIES
+            resp = b''
+            while retries >= 0:
+                try:
+                    data = self._recv_reply(sent_at, request_id)
+                    # the reply can span several reads, it ends in a newline
+                    resp = resp + data if len(data) > 0 else b''
+                    if resp.startswith(b'FILES:') and \
+                            not resp.endswith(b'\n'):
+                        continue
+                    resp = resp.decode('utf-8')
+                    if resp == 'HB-' or len(resp) == 0:
+                        logger.info("server shutting down, reconnecting")
+                        self._lost()
+                        return -2
+                    self._resume_HB()
+                    try:
+                        kind, entries = resp.strip().split(':')
+                        if kind != 'FILES':
+                            raise ValueError(resp)
+                        files = {}
+                        for entry in entries.split('|'):
+                            if len(entry) == 0:
+                                continue
+                            file_no, peers = entry.split('=')
+                            files[int(file_no)] = [] if peers == '-1' else [
+                                tuple(peer.split(','))
+                                for peer in peers.split(';')]
+                        return files
+                    except ValueError:
+                        logger.error("Unknown response received.")
+                        return -1
+                except socket.timeout:
+                    retries -= 1
+            logger.info("server connection broken, reconnecting")
+            self._lost()
+            return -2
+
     def send_success(self, file_no, client_id):
         '''
         Function to send success log message to main server
         param file_no : file number of the successful request
         param client_id : client id of the successful request
         '''
-        with self.wait_HB:
-            if (not self.get_conn_status()):  # connection is dead
+        return self._send_report("LOG", file_no, client_id)
+
+    def send_failure(self, file_no, client_id):
+        '''
+        Function to send failure message to main server, the main server
+        stops counting the upload against the peers
+        param file_no : file number of the failed request
+        param client_id : client id of the failed request
+        '''
+        return self._send_report("FAIL", file_no, client_id)
+
+    def _send_report(self, report, file_no, client_id):
+        '''
+        Function to report the end of a request to the main server
+        param report : LOG for a successful request, FAIL otherwise
+        param file_no : file number of the request
+        param client_id : client id, or comma separated ids, of the peers
+        '''
+        with self._exclusive():
+            if (not self._wait_online()):  # connection is dead
                 return -1
-            self.HB_timer.cancel()  # cancel HB timer
-            self.main_serv.sendall(bytes(f"LOG:{file_no}:{client_id}",
-                                         encoding="utf-8"))
+            self._pause_HB()
+            request_id = self._send(f"{report}:{file_no}:{client_id}")
+            sent_at = time.monotonic()
             retries = constants.CLIENT_MAIN_SERV_RETRIES
             while retries >= 0:
                 try:
-                    self.main_serv.settimeout(
-                        constants.CLIENT_MAIN_SERV_TIMEOUT)
-                    resp = self.main_serv.recv(4096)
+                    resp = self._recv_reply(sent_at, request_id)
                     resp = resp.decode('utf-8')
                     try:
                         _, success = resp.split(':')
                         if success == 'DONE':
-                            logger.info("Success message acknowledged by main"
-                                        " server")
-                            self.HB_timer = threading.Timer(10.0, self.send_HB)
-                            self.HB_timer.start()
+                            logger.info(f"{report} message acknowledged by "
+                                        "main server")
+                            self._resume_HB()
                             return 0
                         else:
                             logger.error("Unknown message received from main"
                                          " server")
                             print("Unknown message received from main server")
-                            self.HB_timer = threading.Timer(10.0, self.send_HB)
-                            self.HB_timer.start()
+                            self._resume_HB()
                             return 0
 
                     except ValueError:
                         if resp == 'HB-' or len(resp) == 0:
-                            logger.info("server shutting down, client shutdown"
-                                        " initiated")
-                            self.set_conn_status(False)
+                            logger.info("server shutting down, reconnecting")
+                            self._lost()
                             return -2
 
                 except socket.timeout:
                     retries -= 1
 
-            logger.info("server connection broken, client shutdown initiated")
-            self.set_close()
-            self.set_conn_status(False)
+            logger.info("server connection broken, reconnecting")
+            self._lost()
             return -1
 
     def send_HB(self):
         '''
         Function to send HeartBeat packets to the main server
         '''
-        with self.wait_HB:
-            self.main_serv.sendall(bytes("HB",
-                                         encoding='utf-8'))
+        with self._exclusive():
+            if not self.online.is_set():  # reconnecting, INIT stands in
+                return
+            request_id = self._send("HB")
             logger.info("Sent HB packet")
-            self.recv_HB()
+            self.recv_HB(time.monotonic(), request_id)
 
-    def recv_HB(self):
+    def recv_HB(self, sent_at, request_id=None):
         '''
         Function to receive HeartBeat packets from main server
+        param sent_at : time the HeartBeat was sent
+        param request_id : id of the HeartBeat, None for text messages
         '''
         retries = constants.CLIENT_MAIN_SERV_HB_RETRIES
         while retries >= 0:
             try:
-                self.main_serv.settimeout(constants.CLIENT_MAIN_SERV_TIMEOUT)
-                HB_resp = self.main_serv.recv(4096)
+                HB_resp = self._recv_reply(sent_at, request_id)
                 if HB_resp.decode('utf-8') == 'HB+':
                     logger.info("received reply to HB")
-                    self.HB_timer = threading.Timer(10.0, self.send_HB)
-                    self.HB_timer.start()
+                    self._start_HB()
                     return
                 elif HB_resp.decode('utf-8') == 'HB-':
-                    logger.info("server shutting down, client shutdown"
-                                " initiated")
-                    self.set_conn_status(False)
+                    logger.info("server shutting down, reconnecting")
+                    self._lost()
                     return
                 if len(HB_resp) == 0:
                     logger.error("Empty reply from server, connection closed.")
-                    self.set_conn_status(False)
+                    self._lost()
                     return
                 else:
                     logger.error("Unknown message received from server."
-                                 " Exiting")
-                    self.set_conn_status(False)
+                                 " Reconnecting")
+                    self._lost()
                     return
             except socket.timeout:
                 logger.info("Timed out")
@@ -229,8 +369,232 @@ class MainServerConn():
 
         logger.error("No replies to HB message, "
                      "connection dead to main server")
+        self._lost()
+
+    def _send(self, message):
+        '''
+        Function to send a message to the main server. Returns the id of the
+        request when messages are framed, None otherwise
+        param message : text of the message
+        '''
+        body = bytes(message, encoding='utf-8')
+        if not (self.framed or self.offer_framing):
+            try:
+                self.main_serv.sendall(body)
+            except OSError as e:  # the reply reads as a closed connection
+                logger.error(f"Could not send to main server: {e}")
+            return None
+        with self.send_lock:
+            request_id = next(self.request_ids)
+            self.pending[request_id] = [threading.Event(), None]
+            data = framing.encode(request_id, body)
+            if not self.framed:  # first message, ask for framed messages
+                data = framing.MAGIC + data
+            try:
+                self.main_serv.sendall(data)
+            except OSError as e:
+                logger.error(f"Could not send to main server: {e}")
+                self._deliver(request_id, b'')
+        return request_id
+
+    def _recv_reply(self, sent_at, request_id=None):
+        '''
+        Function to receive a reply from the main server within the current
+        timeout. Backs off the timeout and raises socket.timeout if the
+        reply does not arrive in time
+        param sent_at : time the request was sent, for the round trip sample
+        param request_id : id of the request, None for text messages
+        '''
+        if self.framed:
+            return self._wait_reply(sent_at, request_id)
+        self.main_serv.settimeout(self.rto.get_rto())
+        try:
+            resp = self.main_serv.recv(4096)
+        except socket.timeout:
+            self.rto.backoff()
+            raise
+        except OSError:  # connection reset, read as closed
+            resp = b''
+        if request_id is not None and resp.startswith(framing.MAGIC):
+            # server accepted framed messages, replies are read in the
+            # background from now on
+            self.framed = True
+            self.frames.feed(resp[len(framing.MAGIC):])
+            self.main_serv.settimeout(None)
+            threading.Thread(target=self._read_frames,
+                             args=(self.main_serv, self.frames),
+                             daemon=True).start()
+            return self._wait_reply(sent_at, request_id)
+        self.pending.pop(request_id, None)
+        self.rto.sample(time.monotonic() - sent_at)
+        return resp
+
+    def _wait_reply(self, sent_at, request_id):
+        '''
+        Function to wait for the framed reply to a request. Raises
+        socket.timeout if it does not arrive in time, the request stays
+        pending so a late reply is still picked up
+        param sent_at : time the request was sent, for the round trip sample
+        param request_id : id of the request
+        '''
+        entry = self.pending[request_id]
+        if not entry[0].wait(self.rto.get_rto()):
+            self.rto.backoff()
+            raise socket.timeout
+        del self.pending[request_id]
+        self.rto.sample(time.monotonic() - sent_at)
+        return entry[1]
+
+    def _read_frames(self, sock, frames):
+        '''
+        Function to read framed replies from the main server and hand each
+        one to the request it answers. Runs until the connection closes
+        param sock : connection to the main server
+        param frames : frame reader of the connection
+        '''
+        while True:
+            try:
+                for request_id, body in frames.frames():
+                    self._deliver(request_id, body)
+                data = sock.recv(65536)
+            except (OSError, ValueError):
+                data = b''
+            if len(data) == 0:
+                # connection closed, wake every request and reconnect
+                # unless a new connection took over
+                if sock is self.main_serv:
+                    for request_id in list(self.pending.keys()):
+                        self._deliver(request_id, b'')
+                    self._lost()
+                return
+            frames.feed(data)
+
+    def _deliver(self, request_id, body):
+        '''
+        Function to hand a framed reply to the request waiting for it
+        param request_id : id of the request the reply answers
+        param body : bytes of the reply
+        '''
+        entry = self.pending.get(request_id)
+        if entry is not None:
+            entry[1] = body
+            entry[0].set()
+        elif body == b'HB-':  # server shutting down, wake every request
+            logger.info("server shutting down, reconnecting")
+            self._lost()
+            for request_id in list(self.pending.keys()):
+                self._deliver(request_id, body)
+        else:
+            logger.error(f"Reply to unknown request {request_id}: {body}")
+
+    def _wait_online(self):
+        '''
+        Function to wait for the connection to the main server while it is
+        reestablished. Returns whether the client is connected
+        '''
+        if self.get_conn_status() and not self.closing:
+            self.online.wait(constants.CLIENT_MAIN_SERV_TIMEOUT)
+        return self.get_conn_status() and self.online.is_set()
+
+    def _lost(self):
+        '''
+        Function to handle losing the connection to the main server. The
+        main server may have restarted and kept the client from its last
+        run, so the client reconnects and sends INIT again in the
+        background. The connection is closed for good when closing
+        '''
+        self.online.clear()
+        with self.reconnect_lock:
+            if self.closing or not self.get_conn_status():
+                self.set_conn_status(False)
+                return
+            if self.reconnecting:
+                return
+            self.reconnecting = True
+        threading.Thread(target=self._reconnect, daemon=True).start()
+
+    def _reconnect(self):
+        '''
+        Function to reconnect to the main server and send INIT again,
+        doubling the wait between tries. The connection is closed once
+        CLIENT_MAIN_SERV_RECONNECT_TRIES tries fail
+        '''
+        self.HB_timer.cancel()
+        delay = constants.CLIENT_MAIN_SERV_RECONNECT_DELAY
+        for _ in range(constants.CLIENT_MAIN_SERV_RECONNECT_TRIES):
+            time.sleep(delay)
+            delay = min(2 * delay,
+                        constants.CLIENT_MAIN_SERV_RECONNECT_MAX_DELAY)
+            if self.closing:
+                break
+            if self._connect() and self.send_init_to_serv(self.config):
+                logger.info("Reconnected to main server")
+                with self.reconnect_lock:
+                    self.reconnecting = False
+                if self.closing:  # closed while the INIT was answered
+                    self.set_close()
+                else:
+                    self._start_HB()
+                return
+        logger.error("Could not reconnect to main server")
+        with self.reconnect_lock:
+            self.reconnecting = False
         self.set_conn_status(False)
 
+    def _connect(self):
+        '''
+        Function to open a new connection to the main server in place of
+        the lost one, requests still waiting on the lost one are woken.
+        Returns whether the main server could be reached
+        '''
+        try:
+            self.main_serv.close()
+        except OSError:
+            pass
+        self.main_serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.framed = False
+        self.frames = framing.FrameReader()
+        for request_id in list(self.pending.keys()):
+            self._deliver(request_id, b'')
+        try:
+            self.main_serv.connect(
+                (socket.gethostbyname(socket.gethostname()), self.serv_port))
+        except OSError:
+            return False
+        return True
+
+    def _exclusive(self):
+        '''
+        Function to get the context a request is made in. Text replies can
+        not be told apart so one request is made at a time, framed requests
+        run concurrently
+        '''
+        if self.framed:
+            return contextlib.nullcontext()
+        return self.wait_HB
+
+    def _start_HB(self):
+        '''
+        Function to start the timer of the next HeartBeat
+        '''
+        self.HB_timer = threading.Timer(10.0, self.send_HB)
+        self.HB_timer.start()
+
+    def _pause_HB(self):
+        '''
+        Function to hold off HeartBeats while a text request is made
+        '''
+        if not self.framed:
+            self.HB_timer.cancel()
+
+    def _resume_HB(self):
+        '''
+        Function to restart HeartBeats after a text request, framed
+        HeartBeats keep running alongside requests
+        '''
+        if not self.framed:
+            self._start_HB()
+
     def get_conn_status(self):
         '''
         Function to get current connection status
@@ -243,12 +607,18 @@ class MainServerConn():
         param status: boolean status to set
         '''
         self.conn_status = status
+        if status:
+            self.closed.clear()
+        else:
+            self.closed.set()
 
     def set_close(self):
         '''
         Function to close server connection
         '''
-        self.main_serv.sendall(b'QUIT')
+        self.closing = True
+        self.online.clear()
+        self._send('QUIT')
         self.set_conn_status(False)
         self.HB_timer.cancel()
 
@@ -1,10 +1,19 @@
 import socket
+import random
+import asyncio
 import logging
 import threading
 import time
+from collections import deque
 
 
+import compress
 import constants
+import packet
+from dgram import DatagramIO
+from pacer import Pacer
+from rto import RTOEstimator
+from timer_wheel import LoopTimers, TimerWheel
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -14,13 +23,31 @@ class myUDPClient():
     '''
     Class for UDP Client
     '''
-    def __init__(self, addr):
+    def __init__(self, addr, version=constants.CLIENT_PACKET_VERSION,
+                 window_size=constants.WINDOW_SIZE):
         '''
         Constructor for UDP Client class
         param addr : address to send and receive messages from
+        param version : packet format to talk to the peer with
+        param window_size : number of packets the client can buffer
         '''
         self.clnt_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.io = DatagramIO(self.clnt_socket)
         self.addr = addr
+        self.version = version
+        # the sequence space has to be twice the window for selective repeat
+        self.window_size = min(window_size,
+                               packet.seq_space(version) // 2)
+        # transfer id echoed by the peer, tells apart stale datagrams
+        self.session = random.getrandbits(32)
+        # receive timeout, sampled from the request to the first reply and
+        # never longer than the fixed timeout it replaces
+        self.rto = RTOEstimator(constants.CLIENT_RECV_TIMEOUT,
+                                max_rto=constants.CLIENT_RECV_TIMEOUT)
+        self.request_sent = None  # send time of the request, None if resent
+        self.requests = 0
+        self.timeouts = 0
+        self.packets = 0
 
     def get_addr(self):
         '''
@@ -47,30 +74,125 @@ class myUDPClient():
         data_type = constants.DATA_ACK
         if (end):
             data_type = constants.END_CONNECTION_ACK
-        data = int(seq_no).to_bytes(1, "big") + \
-            int(data_type).to_bytes(1, "big")
-        self.send(data)
+        self.send(packet.encode(self.version, data_type, seq_no,
+                                session=self.session))
 
-    def recv(self):
+    def send_request(self, file_no, pieces=(0, 0)):
         '''
-        Function to receive data from another client with a set number of
-        retries and a timeout for each receive
+        Function to send the first request packet for a file, carrying the
+        window size the client wants to use for the transfer and the codecs
+        it accepts
+        param file_no : number of the file to request
+        param pieces : first piece and number of pieces to request, (0, 0)
+                       for the whole file
+        '''
+        payload = packet.encode_request(self.version, file_no,
+                                        self.window_size, *pieces,
+                                        codecs=compress.offer())
+        self.requests += 1
+        # karn's rule, a reply to a repeated request is not a sample
+        self.request_sent = time.monotonic() if self.requests == 1 else None
+        self.send(packet.encode(self.version, constants.DATA_PACKET, 0,
+                                payload, self.session))
+
+    def recv(self, retries=constants.CLIENT_MAX_RETRIES):
+        '''
+        Function to receive a packet from another client with a set number of
+        retries and a timeout for each receive. Datagrams that can not be
+        parsed or belong to another session are dropped
+        param retries : number of timeouts before giving up
         '''
-        self.clnt_socket.settimeout(constants.CLIENT_RECV_TIMEOUT)
-        retries = constants.CLIENT_MAX_RETRIES
         while retries >= 0:
+            self.clnt_socket.settimeout(self.rto.get_rto())
             try:
-                data, address = self.clnt_socket.recvfrom(
-                    constants.CLIENT_BUFFER_SIZE)
-                return data
+                data, address = self.io.recv(keep=True)
             except socket.timeout:
+                self.timeouts += 1
+                self.rto.backoff()
                 retries -= 1
+                continue
+            # a legacy peer answers a versioned request in its own format,
+            # but a legacy data packet can look like a versioned one
+            version = None
+            if self.version == constants.LEGACY_PACKET_VERSION:
+                version = self.version
+            try:
+                pkt = packet.decode(data, version)
+            except ValueError:
+                logger.error(f"Malformed packet from {address}: {data}")
+                continue
+            if pkt.version != constants.LEGACY_PACKET_VERSION and \
+                    pkt.session != self.session:
+                logger.info(f"Dropped packet of session {pkt.session}")
+                continue
+            if self.request_sent is not None:
+                self.rto.sample(time.monotonic() - self.request_sent)
+                self.request_sent = None
+            self.rto.reset_backoff()
+            self.packets += 1
+            return pkt
         raise ConnectionError
 
+    def get_stats(self):
+        '''
+        Function to get a dictionary of stats for the transfer on this socket
+        '''
+        stats = self.rto.get_stats()
+        stats.update({'requests': self.requests,
+                      'timeouts': self.timeouts,
+                      'packets': self.packets})
+        return stats
+
     def __del__(self):
         self.clnt_socket.close()
 
 
+class RecvWindow():
+    '''
+    Class for the receiving side of the selective repeat window. Buffers
+    packets that arrive out of order until the gap before them is filled
+    '''
+    def __init__(self, window_size=constants.WINDOW_SIZE,
+                 seq_space=constants.MAX_SEQ_NO):
+        '''
+        Constructor for the receive window
+        param window_size : number of packets that can be buffered
+        param seq_space : number of sequence numbers before they wrap
+        '''
+        self.window_size = window_size
+        self.seq_space = seq_space
+        self.base = 0  # next sequence number to be delivered
+        self.buffer = {}
+
+    def offer(self, pkt):
+        '''
+        Function to offer a received packet to the window. Returns True if
+        the packet should be acknowledged (new or already delivered) and
+        False if it falls outside the window and must be dropped
+        param pkt : the received Packet
+        '''
+        offset = (pkt.seq_no - self.base) % self.seq_space
+        # inside the current window, buffer it if it is not a duplicate
+        if offset < self.window_size:
+            if pkt.seq_no not in self.buffer:
+                self.buffer[pkt.seq_no] = pkt
+            return True
+        # already delivered packet, the ack must have been lost
+        if offset >= self.seq_space - self.window_size:
+            return True
+        return False
+
+    def pop_ready(self):
+        '''
+        Function to yield the packets that can be delivered in order and
+        move the window forward past them
+        '''
+        while self.base in self.buffer:
+            pkt = self.buffer.pop(self.base)
+            self.base = (self.base + 1) % self.seq_space
+            yield pkt
+
+
 class myUDPServer():
     '''
     Class for UDP Server
@@ -84,7 +206,15 @@ class myUDPServer():
         '''
         self.clients = {}
         self.clients_lock = threading.Lock()
+        # single thread running the resend timers of all clients
+        self.timers = TimerWheel()
+        # clients with packets waiting on the pacer for a send slot
+        self.paced = set()
+        # clients whose next piece was compressed, their window is loaded
+        # further by the listen loop
+        self.refill = deque()
         self.serv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.io = DatagramIO(self.serv_socket, constants.SERVER_BUFFER_SIZE)
         self.serv_success = False
         try:
             self.serv_socket.bind((socket.gethostbyname(socket.gethostname()),
@@ -113,190 +243,380 @@ class myUDPServer():
         '''
         logger.info("Server listen set to close")
         self.init_close = True
+        self._wake()
+
+    def _wake(self):
+        '''
+        Function to wake the listen loop blocked on the socket with an empty
+        datagram, so a close is seen right away
+        '''
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(b'', self.serv_socket.getsockname())
+        except OSError:
+            pass
 
     def listen(self):
         '''
         Function for the server to listen at port specified by initialization
         parameters
         '''
+        self.timers.start()
         while True and (not self.init_close) or len(self.clients) > 0:
-            self.serv_socket.settimeout(constants.SERVER_RECV_TIMEOUT)
+            self.serv_socket.settimeout(self._recv_timeout())
             try:
-                data, addr = self.serv_socket.recvfrom(
-                    constants.SERVER_BUFFER_SIZE)
-                with self.clients_lock:
-                    if (data[0] == 0 and data[1] == 0):  # new client
-                        logger.info(f"New connection request from {addr}"
-                                    f" for file {data[2]}")
-
-                        # accept no more init requests
-                        if (self.init_close):
-                            self.clients[addr] = {'requested_file': data[2],
-                                                  'reader': None,
-                                                  'status': 'terminate',
-                                                  'retries':
-                                                  constants.SERVER_MAX_RETRIES,
-                                                  'lock': threading.Lock()}
-
-                            self.clients[addr]['timer'] = threading.Timer(
-                                constants.SERVER_TIMER_THREAD_TIMEOUT,
-                                self.resend, addr)
-                            self.clients[addr]['timer'].start()
-                            self._send_close(addr)
-                            continue
-
-                        # if client does not have file
-                        if (not self.file_mgr.checkFile(data[2])):
-                            logger.error(f"File {data[2]} not found locally")
-                            self.clients[addr] = {'requested_file': data[2],
-                                                  'reader': None,
-                                                  'status': 'not found',
-                                                  'retries':
-                                                  constants.SERVER_MAX_RETRIES,
-                                                  'lock': threading.Lock()}
-
-                            self.clients[addr]['timer'] = threading.Timer(
-                                constants.SERVER_TIMER_THREAD_TIMEOUT,
-                                self.resend, addr)  # start a timer for receive
-                            self.clients[addr]['timer'].start()
-                            self._send_close(addr, 1)
-                            continue
-
-                        # initialize the reader object
-                        reader = self.file_mgr.newRead(int(data[2]))
-
-                        # initialize bookkeeping for the client
-                        self.clients[addr] = {'requested_file': data[2],
-                                              'reader': reader,
-                                              'window': {},
-                                              'status': 'active',
-                                              'retries':
-                                              constants.SERVER_MAX_RETRIES,
-                                              'lock': threading.Lock()}
-                        # load window
-                        self.load_window(addr, -1)  # initialize
-
-                        # send window to client
-                        self.send_window(addr)
-
-                        # initialize timer to resend packet in case lost
-                        self.clients[addr]['timer'] = threading.Timer(
-                            constants.SERVER_TIMER_THREAD_TIMEOUT,
-                            self.resend, addr)
-                        self.clients[addr]['timer'].start()
-
-                    # if packet is an ack packet
-                    elif (data[1] == 1):  # this is an ack
-                        logger.info(f"Received ACK from {addr} for "
-                                    f"seq_no: {data[0]}")
-
-                        # server does not know this client, maybe expired
-                        # connection or it was shutdown
-                        if addr not in self.clients.keys():
-                            self.clients[addr] = {'requested_file': None,
-                                                  'reader': None,
-                                                  'status': 'terminate',
-                                                  'retries':
-                                                  constants.SERVER_MAX_RETRIES,
-                                                  'lock': threading.Lock()}
-                            self.clients[addr]['timer'] = threading.Timer(
-                                constants.SERVER_TIMER_THREAD_TIMEOUT,
-                                self.resend, addr)
-                            self.clients[addr]['timer'].start()
-                            self._send_close(addr)
-                            continue
-                        # try to get lock to modify shared dictionary
-                        with self.clients[addr]['lock']:
-
-                            # reset retries
-                            self.clients[addr]['retries'] = \
-                                constants.SERVER_MAX_RETRIES
-
-                            # cancel timer thread
-                            self.clients[addr]['timer'].cancel()
-
-                            # if it is duplicate ack
-                            window_keys = self.clients[addr]['window'].keys()
-                            if data[0] not in window_keys:
-                                if len(window_keys) != 0:
-                                    self.clients[addr]['timer'] = \
-                                        threading.Timer(
-                                        constants.SERVER_TIMER_THREAD_TIMEOUT,
-                                        self.resend, addr)
-                                    self.clients[addr]['timer'].start()
-                                continue
-                            # flag to do nothing if window has not moved
-                            do_nothing = False
-
-                            self.clients[addr]['window'][data[0]][2] = \
-                                constants.DATA_ACK
-
-                            # if there is more than one packet in window
-                            if len(list(window_keys)) > 1:
-                                # move only
-                                if data[0] == list(window_keys)[-2]:
-                                    do_nothing = True
-
-                            # move the window only
-                            self.send_window(addr, move_only=True)
-
-                            if do_nothing:
-                                self.clients[addr]['timer'] = threading.Timer(
-                                    constants.SERVER_TIMER_THREAD_TIMEOUT,
-                                    self.resend, addr)
-                                self.clients[addr]['timer'].start()
-                                continue
-                            # nothing more to send to this client and
-                            # connection ended
-                            if (len(self.clients[addr]['window']) == 0):
-                                del self.clients[addr]
-                                continue
-
-                            # send window to client
-                            self.send_window(addr)
-
-                            # restart timer
-                            self.clients[addr]['timer'] = threading.Timer(
-                                constants.SERVER_TIMER_THREAD_TIMEOUT,
-                                self.resend, addr)
-                            self.clients[addr]['timer'].start()
-
-                    # user shutdown close ack
-                    elif data[1] == constants.END_CONNECTION_ACK:
-                        self.clients[addr]['timer'].cancel()
-                        logger.info(f"Closed connection to {addr}")
-                        del self.clients[addr]
-                        continue
-
-                    else:
-                        logger.error("Unknown request received with data "
-                                     f"{data} from {addr}, setting connection "
-                                     "to terminate")
-                        if addr not in self.clients.keys():
-                            self.clients[addr] = {'requested_file': None,
-                                                  'reader': None,
-                                                  'status': 'terminate',
-                                                  'retries':
-                                                  constants.SERVER_MAX_RETRIES,
-                                                  'lock': threading.Lock()}
-                            self.clients[addr]['timer'] = threading.Timer(
-                                constants.SERVER_TIMER_THREAD_TIMEOUT,
-                                self.resend, addr)
-                            self.clients[addr]['timer'].start()
-                            self._send_close(addr)
-                            continue
-                        else:
-                            self.clients[addr]['timer'].cancel()
-                            self.clients[addr]['status'] = 'terminate'
-                            self.clients[addr]['retries'] = \
-                                constants.SERVER_MAX_RETRIES
-                            self.clients[addr]['timer'] = threading.Timer(
-                                constants.SERVER_TIMER_THREAD_TIMEOUT,
-                                self.resend, addr)
-                            self.clients[addr]['timer'].start()
-                            continue
+                data, addr = self.io.recv()
+                try:
+                    pkt = packet.decode(data) if len(data) > 0 else None
+                except ValueError:
+                    logger.error(f"Malformed packet {bytes(data)} from {addr}")
+                    pkt = None
+                if pkt is not None:
+                    file_no = self._uncached_file(pkt)
+                    if file_no is not None:
+                        self._hash_file(file_no)
+                    with self.clients_lock:
+                        self._handle(pkt, addr)
             except socket.timeout:
+                pass
+            self._refill_windows()
+            self._send_paced()
+        self.timers.stop()
+
+    def _uncached_file(self, pkt):
+        '''
+        Function to find the file a request packet asks for if its hashes
+        are not cached, a file not hashed at startup yet or changed since.
+        They are computed before clients_lock is taken, so hashing does not
+        hold up the other transfers. Returns None for any other packet
+        param pkt : decoded Packet received
+        '''
+        if pkt.seq_no != 0 or pkt.type != constants.DATA_PACKET:
+            return None
+        try:
+            file_no = int(packet.decode_request(pkt)[0])
+            if self.file_mgr.checkFile(file_no) and \
+                    self.file_mgr.cachedHashes(file_no) is None:
+                return file_no
+        except (ValueError, OSError):
+            pass
+        return None
+
+    def _hash_file(self, file_no):
+        '''
+        Function to hash a file into the cache of the file manager, without
+        holding clients_lock
+        param file_no : number of the file to hash
+        '''
+        try:
+            self.file_mgr.getHashes(file_no)
+        except OSError as e:
+            logger.error(f"Failed to hash file {file_no}: {e}")
+
+    def _new_client(self, pkt, status, file_no=None):
+        '''
+        Function to create the bookkeeping of a client, transfers add their
+        window state on top of it
+        param pkt : packet received from the client
+        param status : 'active', 'terminate' or 'not found'
+        param file_no : file requested by the client, if any
+        '''
+        return {'requested_file': file_no,
+                'reader': None,
+                'status': status,
+                'version': pkt.version,
+                'session': pkt.session,
+                'retries': constants.SERVER_MAX_RETRIES}
+
+    def _handle(self, pkt, addr):
+        '''
+        Function to handle a packet received from a client. Must be called
+        with clients_lock held
+        param pkt : decoded Packet received
+        param addr : address the packet came from
+        '''
+        # stale datagram from an earlier transfer on the same address
+        if addr in self.clients.keys() and \
+                pkt.version != constants.LEGACY_PACKET_VERSION and \
+                pkt.session != self.clients[addr]['session']:
+            logger.info(f"Dropped packet of session {pkt.session} "
+                        f"from {addr}")
+            return
+
+        if (pkt.seq_no == 0 and pkt.type == constants.DATA_PACKET):
+            try:
+                file_no, window_size, first, count, codecs = \
+                    packet.decode_request(pkt)
+            except ValueError:
+                file_no = None
+            if file_no is not None:
+                self._handle_request(pkt, addr, file_no, window_size,
+                                     (first, count), codecs)
+                return
+
+        # if packet is an ack packet
+        elif (pkt.type == constants.DATA_ACK):  # this is an ack
+            logger.info(f"Received ACK from {addr} for "
+                        f"seq_no: {pkt.seq_no}")
+
+            # server does not know this client, maybe expired
+            # connection or it was shutdown
+            if addr not in self.clients.keys():
+                self.clients[addr] = self._new_client(pkt, 'terminate')
+                self._arm_timer(addr)
+                self._send_close(addr)
+                return
+            # ack for a session that is closing or unknown file
+            if self.clients[addr]['status'] != 'active':
+                return
+            self._handle_ack(addr, pkt.seq_no)
+            return
+
+        # user shutdown close ack
+        elif pkt.type == constants.END_CONNECTION_ACK:
+            if addr not in self.clients.keys():
+                return
+            self._cancel_timer(addr)
+            logger.info(f"Closed connection to {addr}")
+            del self.clients[addr]
+            return
+
+        logger.error(f"Unknown request received with data {pkt} from "
+                     f"{addr}, setting connection to terminate")
+        if addr not in self.clients.keys():
+            self.clients[addr] = self._new_client(pkt, 'terminate')
+            self._arm_timer(addr)
+            self._send_close(addr)
+        else:
+            self._cancel_timer(addr)
+            self.clients[addr]['status'] = 'terminate'
+            self.clients[addr]['retries'] = constants.SERVER_MAX_RETRIES
+            self._arm_timer(addr)
+
+    def _handle_request(self, pkt, addr, file_no, window_size, pieces,
+                        codecs=0):
+        '''
+        Function to start a transfer for a request packet. Must be called
+        with clients_lock held
+        param pkt : decoded request Packet
+        param addr : address of the client
+        param file_no : number of the file requested
+        param window_size : window size asked for by the client
+        param pieces : first piece and number of pieces requested
+        param codecs : bit mask of the codecs the client accepts
+        '''
+        logger.info(f"New connection request from {addr} for file {file_no}")
+
+        # repeated request, the window is already on its
+        # way and the resend timer covers any loss
+        if addr in self.clients.keys():
+            return
+
+        # accept no more init requests
+        if (self.init_close):
+            self.clients[addr] = self._new_client(pkt, 'terminate', file_no)
+            self._arm_timer(addr)
+            self._send_close(addr)
+            return
+
+        # if client does not have file
+        if (not self.file_mgr.checkFile(file_no)):
+            logger.error(f"File {file_no} not found locally")
+            self.clients[addr] = self._new_client(pkt, 'not found', file_no)
+            self._arm_timer(addr)  # start a timer for receive
+            self._send_close(addr, 1)
+            return
+
+        # initialize the reader object, legacy peers only know the file hash
+        if pkt.version == constants.LEGACY_PACKET_VERSION:
+            pieces = None
+        reader = self.file_mgr.newRead(int(file_no),
+                                       packet.payload_size(pkt.version),
+                                       pieces, compress.choose(codecs))
+
+        # the window can use at most half of the sequence space
+        seq_space = packet.seq_space(pkt.version)
+        window_size = max(1, min(window_size, constants.MAX_WINDOW_SIZE,
+                                 seq_space // 2))
+
+        # initialize bookkeeping for the client
+        self.clients[addr] = self._new_client(pkt, 'active', file_no)
+        self.clients[addr].update({'reader': reader,
+                                   'seq_space': seq_space,
+                                   'window': {},
+                                   'window_size': window_size,
+                                   # window sequence numbers in order
+                                   'order': deque(),
+                                   # sequence numbers waiting to be sent
+                                   'unsent': deque(),
+                                   'resend': deque(),
+                                   'next_seq': 0,
+                                   'end_loaded': False,
+                                   'in_flight': 0,
+                                   'pacer': Pacer(window_size),
+                                   'rto': RTOEstimator(
+                                       constants.SERVER_TIMER_THREAD_TIMEOUT)})
+        # load window
+        self.load_window(addr)  # initialize
+
+        # send window to client
+        self.send_window(addr)
+
+        # initialize timer to resend packet in case lost
+        self._arm_timer(addr)
+
+    def _handle_ack(self, addr, seq_no):
+        '''
+        Function to handle an ack for an active transfer. Must be called with
+        clients_lock held
+        param addr : address of the client
+        param seq_no : sequence number acknowledged
+        '''
+        # reset retries
+        self.clients[addr]['retries'] = constants.SERVER_MAX_RETRIES
+
+        # cancel timer thread
+        self._cancel_timer(addr)
+
+        # if it is duplicate ack
+        window = self.clients[addr]['window']
+        if seq_no not in window.keys() or \
+                window[seq_no]['status'] == constants.DATA_ACK:
+            if len(window) != 0:
+                self._arm_timer(addr)
+            return
+        self._ack_packet(addr, seq_no)
+
+        # move the window and send whatever the pacer
+        # allows, the rest is still in flight
+        self.send_window(addr)
+
+        # nothing more to send to this client and
+        # connection ended
+        if (len(self.clients[addr]['window']) == 0):
+            # the next piece is still being compressed, the timer is armed
+            # again once the window is loaded
+            if not self.clients[addr]['end_loaded']:
+                return
+            logger.info(f"Transfer to {addr} complete, "
+                        f"stats: {self.get_stats(addr)}")
+            del self.clients[addr]
+            return
+
+        # restart timer
+        self._arm_timer(addr)
+
+    def _arm_timer(self, addr):
+        '''
+        Function to (re)start the resend timer of a client on the shared
+        timer wheel. Must be called with clients_lock held
+        param addr : address of the client
+        '''
+        timeout = constants.SERVER_TIMER_THREAD_TIMEOUT
+        if 'rto' in self.clients[addr].keys():
+            timeout = self.clients[addr]['rto'].get_rto()
+        self.clients[addr]['timer'] = self.timers.schedule(
+            timeout, self.resend, *addr)
+
+    def _cancel_timer(self, addr):
+        '''
+        Function to stop the resend timer of a client. Must be called with
+        clients_lock held
+        param addr : address of the client
+        '''
+        if 'timer' in self.clients[addr].keys():
+            self.timers.cancel(self.clients[addr]['timer'])
+
+    def get_stats(self, addr):
+        '''
+        Function to get a dictionary of stats for the transfer to a client
+        param addr : address of the client
+        '''
+        client = self.clients[addr]
+        stats = {'status': client['status'],
+                 'version': client['version'],
+                 'retries': client['retries']}
+        if 'rto' in client.keys():
+            stats.update(client['pacer'].get_stats())
+            stats.update(client['rto'].get_stats())
+            stats['in_flight'] = client['in_flight']
+        return stats
+
+    def _recv_timeout(self):
+        '''
+        Function to get how long the listen loop can block on the socket,
+        it has to wake up in time for clients waiting on their pacer
+        '''
+        timeout = constants.SERVER_RECV_TIMEOUT
+        now = time.monotonic()
+        for addr in list(self.paced):
+            client = self.clients.get(addr)
+            if client is None or 'pacer' not in client:
+                self.paced.discard(addr)
                 continue
+            timeout = min(timeout, client['pacer'].next_send_time() - now)
+        return max(timeout, constants.PACER_MIN_RTT)
+
+    def _send_paced(self):
+        '''
+        Function to send the packets of clients that were waiting on their
+        pacer for a send slot
+        '''
+        if len(self.paced) == 0:
+            return
+        with self.clients_lock:
+            for addr in list(self.paced):
+                if addr not in self.clients.keys():
+                    self.paced.discard(addr)
+                    continue
+                self._send_window(addr)
+
+    def _ack_packet(self, addr, seq_no):
+        '''
+        Function to mark a packet as acknowledged and feed the ack to the
+        pacer. Acks that skip over older packets mark those as lost
+        param addr : address of the client
+        param seq_no : sequence number acknowledged
+        '''
+        client = self.clients[addr]
+        entry = client['window'][seq_no]
+        entry['status'] = constants.DATA_ACK
+        entry['pending'] = False
+        client['in_flight'] -= 1
+        if entry['sends'] == 1:  # karn's rule, no sample from resends
+            client['rto'].sample(time.monotonic() - entry['sent_at'])
+        client['pacer'].on_ack(len(entry['data']), client['rto'].srtt)
+
+        # the window is moved after every ack, so it starts with the oldest
+        # unacked packet unless that is the one just acked
+        oldest = client['order'][0]
+        if oldest == seq_no:
+            return
+        skipped = (seq_no - oldest) % client['seq_space']
+        lost = client['window'][oldest]
+        if skipped >= constants.FAST_RETRANSMIT_THRESHOLD and \
+                lost['sends'] == 1 and not lost['pending']:
+            logger.info(f"Fast retransmit of seq {oldest} to {addr}")
+            lost['pending'] = True
+            client['resend'].append(oldest)
+            client['pacer'].on_loss()
+
+    def _sendto(self, payload, addr):
+        '''
+        Function to send a datagram to a client
+        param payload : bytes to send
+        param addr : address of the client
+        '''
+        self.serv_socket.sendto(payload, addr)
+
+    def _send_datagrams(self, datagrams, addr):
+        '''
+        Function to send several datagrams to a client with as few system
+        calls as the socket allows
+        param datagrams : list of (header, payload) of the datagrams
+        param addr : address of the client
+        '''
+        self.io.send(datagrams, addr)
 
     def _send_close(self, addr, type=0):
         '''
@@ -304,37 +624,65 @@ class myUDPServer():
         param addr : address to send message to
         param type : type of closing message to send
         '''
-        payload = int(0).to_bytes(1, "big") + \
-            int(constants.SERVER_END_ABNORMAL).to_bytes(1, "big")
+        pkt_type = constants.SERVER_END_ABNORMAL
 
         # file not found
         if (type == 1):
-            payload = int(0).to_bytes(1, "big") + \
-                int(constants.SERVER_FILE_NOT_FOUND).to_bytes(1, "big")
-        self.serv_socket.sendto(payload, addr)
+            pkt_type = constants.SERVER_FILE_NOT_FOUND
+        payload = packet.encode(self.clients[addr]['version'], pkt_type, 0,
+                                session=self.clients[addr]['session'])
+        self._sendto(payload, addr)
         logger.info(f"Sent {payload} to {addr}")
 
     def _send_window(self, addr):
         '''
-        Low level function to send the current window contents (only packets
-        that have not been acknowledged)
+        Low level function to send the window packets waiting to be sent
+        (packets marked for retransmission first, then new packets), as far
+        as the pacer of the client allows
         param addr : address to send the window to
         '''
-        # for all the keys in the window
-        for i in self.clients[addr]['window'].keys():
-            if self.clients[addr]['window'][i][2] == constants.DATA_PACKET:
-                seq_no = int(i).to_bytes(1, "big")
-                data_type = self.clients[addr]['window'][i][1].to_bytes(1,
-                                                                        "big")
-                data = self.clients[addr]['window'][i][0]
+        client = self.clients[addr]
+        pacer = client['pacer']
+        blocked = False
+        datagrams = []
+        while len(client['resend']) > 0 or len(client['unsent']) > 0:
+            retransmit = len(client['resend']) > 0
+            queue = client['resend'] if retransmit else client['unsent']
+            entry = client['window'].get(queue[0])
+            # acked while it was waiting
+            if entry is None or not entry['pending']:
+                queue.popleft()
+                continue
+            if pacer.allowance(client['in_flight'], retransmit) == 0:
+                blocked = True
+                break
+            seq_no = queue.popleft()
+            entry['pending'] = False
+            if not retransmit:
+                client['in_flight'] += 1
+            entry['sends'] += 1
+            entry['sent_at'] = time.monotonic()
+            pacer.on_send()
 
-                # prepare payload
-                payload = seq_no + data_type + bytes(data)
-                self.serv_socket.sendto(payload, addr)
-                logger.info(f"Sent data with seq {i}")
+            # prepare the header, sent along with the data as it is
+            flags = entry['flags']
+            if retransmit:
+                flags |= constants.FLAG_RETRANSMIT
+            header = packet.encode_header(client['version'], entry['type'],
+                                          seq_no, client['session'],
+                                          entry['offset'], flags)
+            datagrams.append((header, entry['data']))
+            logger.info(f"Sent data with seq {seq_no}")
+        # everything the pacer allowed goes out at once
+        if len(datagrams) > 0:
+            self._send_datagrams(datagrams, addr)
 
-                # wait some time before sending the next packet
-                time.sleep(0.1)
+        # wait for the pacer to release a send slot, a full window waits for
+        # acks instead and does not wake the listen loop
+        if blocked and pacer.starved():
+            self.paced.add(addr)
+        else:
+            self.paced.discard(addr)
 
     def send_window(self, addr, move_only=False):
         '''
@@ -344,60 +692,94 @@ class myUDPServer():
         param move_only : flag to do move only operations and not send
                           operations
         '''
-        # if there is a non acknowledged packet before
-        delFlag = True
-        # if the end packet is in the window
-        endFlag = False
-
-        if (len(self.clients[addr]['window']) == 0):
-            return
-        seq_no = list(self.clients[addr]['window'].keys())[-1]
-        for i in list(self.clients[addr]['window'].keys()):
-            if self.clients[addr]['window'][i][1] == \
-                    constants.SERVER_END_PACKET:
-                endFlag = True
-            if self.clients[addr]['window'][i][2] == constants.DATA_ACK \
-                    and delFlag:
-                logger.info(f'deleting {i}')
-                del self.clients[addr]['window'][i]
-            else:
-                delFlag = False
-        if not endFlag:
-            self.load_window(addr, seq_no)
+        client = self.clients[addr]
+        # delete acknowledged packets from the start of the window
+        while len(client['order']) > 0 and \
+                client['window'][client['order'][0]]['status'] == \
+                constants.DATA_ACK:
+            logger.info(f"deleting {client['order'][0]}")
+            del client['window'][client['order'].popleft()]
+        # if the end packet is in the window there is nothing more to load
+        if not client['end_loaded']:
+            self.load_window(addr)
         if not move_only:
             self._send_window(addr)
 
-    def load_window(self, addr, seq_no):
+    def load_window(self, addr):
         '''
         Function to load contents into the window by using the reader assigned
         to request
         param addr : address of the client
-        param seq_no : sequence number of last packet in the window
         '''
-        # generate next sequence number
-        seq_no = (seq_no + 1) % (constants.MAX_SEQ_NO)
-
-        while len(self.clients[addr]['window']) < constants.WINDOW_SIZE:
+        client = self.clients[addr]
+        while len(client['window']) < client['window_size']:
             try:
                 # get the next chunk from the reader
-                data = next(self.clients[addr]['reader'])
-                # add it to the window with the seq_no as key
-                self.clients[addr]['window'][seq_no] = [data[0], data[1],
-                                                        constants.DATA_PACKET]
-
+                data = next(client['reader'])
             except StopIteration:  # reached the end of the generator
+                client['end_loaded'] = True
+                break
+            # the piece is still being compressed, the window is loaded
+            # further once it is
+            if data[1] == constants.READ_PENDING:
+                if client.get('packing') is not data[0]:
+                    client['packing'] = data[0]
+                    data[0].add_done_callback(
+                        lambda _: self._compressed(addr))
                 break
-            seq_no = (seq_no + 1) % (constants.MAX_SEQ_NO)
+            seq_no = client['next_seq']
+            # add it to the window with the seq_no as key, not sent yet
+            client['window'][seq_no] = {'data': data[0],
+                                        'type': data[1],
+                                        'offset': data[2],
+                                        'flags': data[3],
+                                        'status': constants.DATA_PACKET,
+                                        'sends': 0,
+                                        'sent_at': None,
+                                        'pending': True}
+            client['order'].append(seq_no)
+            client['unsent'].append(seq_no)
+            # generate next sequence number
+            client['next_seq'] = (seq_no + 1) % client['seq_space']
+            if data[1] == constants.SERVER_END_PACKET:
+                client['end_loaded'] = True
+                break
+
+    def _compressed(self, addr):
+        '''
+        Function called by the compressor once the piece a client waits on is
+        compressed, wakes the listen loop up to load its window
+        param addr : address of the client
+        '''
+        self.refill.append(addr)
+        self._wake()
+
+    def _refill_windows(self):
+        '''
+        Function to load and send the windows of the clients whose next piece
+        was compressed
+        '''
+        if len(self.refill) == 0:
+            return
+        with self.clients_lock:
+            while len(self.refill) > 0:
+                addr = self.refill.popleft()
+                client = self.clients.get(addr)
+                if client is None or 'window' not in client or \
+                        client['status'] != 'active':
+                    continue
+                self.send_window(addr)
+                if len(self.clients[addr]['window']) > 0:
+                    self._arm_timer(addr)
 
     def _declare_dead(self, addr):
         '''
         Function to declare a client as dead and remove it from the shared
-        dictionary between threads
+        dictionary between threads. Must be called with clients_lock held
         param addr : address of the client to be deleted from shared dictionary
         '''
-        with self.clients_lock:
-            logger.warning(f"Client with address {addr} declared dead.")
-            del self.clients[addr]
+        logger.warning(f"Client with address {addr} declared dead.")
+        del self.clients[addr]
 
     def resend(self, *args):
         '''
@@ -406,75 +788,69 @@ class myUDPServer():
         param port : port to reach the client at
         '''
         addr = (args[0], args[1])
-        # do nothing if client is not in the shared dictionary anymore
-        if addr not in self.clients.keys():
-            return
+        with self.clients_lock:
+            # do nothing if client is not in the shared dictionary anymore
+            if addr not in self.clients.keys():
+                return
+            # timer was re-armed by the receiving thread while this one was
+            # about to fire
+            if not self.clients[addr]['timer'].fired:
+                return
 
-        # if it is not able to acquire this lock immediately,
-        # then it must be locked by receiving thread
-        if self.clients[addr]['lock'].acquire(False):
             logger.warning(f"Resend called for {addr} as no ack received."
                            f" Retry count: {self.clients[addr]['retries']}")
-            # since we need to release lock after we delete client
-            lock = self.clients[addr]['lock']
-            try:
-                # file not found case
-                if (self.clients[addr]['status'] == 'not found'):
-                    if self.clients[addr]['retries'] < 0:  # retries expired
-                        logger.info("Retries expired for closing request"
-                                    f"or terminated client {addr}")
-                        self._declare_dead(addr)
-                        return
-
-                    self.clients[addr]['retries'] -= 1
-                    self.clients[addr]['timer'] = threading.Timer(
-                        constants.SERVER_TIMER_THREAD_TIMEOUT,
-                        self.resend, addr)
-                    self.clients[addr]['timer'].start()  # restart timer
-                    self._send_close(addr, 1)
-                    return
-
-                # if client status is set to terminate
-                if (self.clients[addr]['status'] == 'terminate'):
-                    if self.clients[addr]['retries'] < 0:  # retries expired
-                        logger.info("Retries expired for closing request "
-                                    f"or terminated client {addr}")
-                        self._declare_dead(addr)
-                        return
-                    # resend close message
-                    self._send_close(addr)
-                    self.clients[addr]['retries'] -= 1
-                    self.clients[addr]['timer'] = threading.Timer(
-                        constants.SERVER_TIMER_THREAD_TIMEOUT,
-                        self.resend, (addr))
-                    self.clients[addr]['timer'].start()  # restart timer
-                    return
-
-                # nothing more to send to the client
-                if len(self.clients[addr]['window']) == 0:
-                    logger.info(f"Nothing more to send to {addr}, "
-                                "declared dead.")
+            # file not found case
+            if (self.clients[addr]['status'] == 'not found'):
+                if self.clients[addr]['retries'] < 0:  # retries expired
+                    logger.info("Retries expired for closing request"
+                                f"or terminated client {addr}")
                     self._declare_dead(addr)
                     return
 
-                # normal client status
+                self.clients[addr]['retries'] -= 1
+                self._arm_timer(addr)  # restart timer
+                self._send_close(addr, 1)
+                return
+
+            # if client status is set to terminate
+            if (self.clients[addr]['status'] == 'terminate'):
                 if self.clients[addr]['retries'] < 0:  # retries expired
+                    logger.info("Retries expired for closing request "
+                                f"or terminated client {addr}")
                     self._declare_dead(addr)
                     return
-                else:
-                    self.clients[addr]['retries'] -= 1
-                    self.send_window(addr)
-                    self.clients[addr]['timer'] = threading.Timer(
-                        constants.SERVER_TIMER_THREAD_TIMEOUT,
-                        self.resend, (addr))
-                    self.clients[addr]['timer'].start()  # restart timer
-                    return
-            finally:
-                lock.release()
-        else:
-            logger.debug("Locked by receiving thread")
-        # if the lock is being used by server receive thread for this address
-        # then do nothing
+                # resend close message
+                self._send_close(addr)
+                self.clients[addr]['retries'] -= 1
+                self._arm_timer(addr)  # restart timer
+                return
+
+            # nothing more to send to the client
+            if len(self.clients[addr]['window']) == 0:
+                logger.info(f"Nothing more to send to {addr}, "
+                            "declared dead.")
+                self._declare_dead(addr)
+                return
+
+            # normal client status
+            if self.clients[addr]['retries'] < 0:  # retries expired
+                self._declare_dead(addr)
+                return
+            else:
+                self.clients[addr]['retries'] -= 1
+                # everything in flight is considered lost
+                client = self.clients[addr]
+                for seq_no in client['order']:
+                    entry = client['window'][seq_no]
+                    if entry['status'] == constants.DATA_PACKET and \
+                            entry['sends'] > 0 and not entry['pending']:
+                        entry['pending'] = True
+                        client['resend'].append(seq_no)
+                client['pacer'].on_timeout()
+                client['rto'].backoff()
+                self.send_window(addr)
+                self._arm_timer(addr)  # restart timer
+                return
 
     def __del__(self):
         '''
@@ -482,3 +858,189 @@ class myUDPServer():
         '''
         if self.serv_success:
             self.serv_socket.close()
+
+
+class myAsyncUDPServer(myUDPServer, asyncio.DatagramProtocol):
+    '''
+    Class for the UDP Server running on an asyncio event loop. Speaks the same
+    protocol with the same per client state as myUDPServer, but datagrams,
+    resend timers and paced sends are all handled by the loop, without a
+    receive timeout or a timer thread
+    '''
+    def __init__(self, port, file_mgr):
+        '''
+        Constructor for the asyncio UDP Server
+        param port : port to bind the server to
+        param file_mgr : file manager of the client, of type ClientFile
+        '''
+        super().__init__(port, file_mgr)
+        self.loop = None
+        self.transport = None
+        self.pacing = None  # loop callback sending paced packets
+        self.closing = None  # set by the datagram set_close wakes us with
+        # files hashed on a worker, the requests waiting on each
+        self.hashing = {}
+
+    def listen(self):
+        '''
+        Function for the server to listen at port specified by initialization
+        parameters, runs an event loop until the server is closed
+        '''
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        '''
+        Coroutine serving clients until the server is set to close and no
+        client is left
+        '''
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.timers = LoopTimers(loop)
+        self.closing = asyncio.Event()
+        await loop.create_datagram_endpoint(lambda: self,
+                                            sock=self.serv_socket)
+        try:
+            if not self.init_close:
+                await self.closing.wait()
+            # let the transfers in progress finish
+            while len(self.clients) > 0:
+                await asyncio.sleep(constants.SERVER_RECV_TIMEOUT)
+        finally:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        '''
+        Function called by the loop once the socket is ready
+        param transport : datagram transport of the socket
+        '''
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        '''
+        Function called by the loop for every datagram received
+        param data : bytes of the datagram
+        param addr : address the datagram came from
+        '''
+        if len(data) == 0:  # woken up by set_close
+            if self.init_close:
+                self.closing.set()
+            return
+        try:
+            pkt = packet.decode(data)
+        except ValueError:
+            logger.error(f"Malformed packet {data} from {addr}")
+            return
+        file_no = self._uncached_file(pkt)
+        if file_no is not None:
+            # hash on a worker so the loop keeps serving, the request is
+            # handled once the hashes are cached
+            if file_no not in self.hashing:
+                self.hashing[file_no] = []
+                self.loop.run_in_executor(
+                    None, self._hash_file, file_no).add_done_callback(
+                        lambda _: self._hashed(file_no))
+            self.hashing[file_no].append((pkt, addr))
+            return
+        self._received(pkt, addr)
+
+    def _hashed(self, file_no):
+        '''
+        Function run by the loop once a file was hashed, handles the
+        requests that waited on it
+        param file_no : number of the file hashed
+        '''
+        for pkt, addr in self.hashing.pop(file_no):
+            self._received(pkt, addr)
+
+    def _received(self, pkt, addr):
+        '''
+        Function to handle a packet and send what the pacer allows
+        param pkt : decoded Packet received
+        param addr : address the packet came from
+        '''
+        with self.clients_lock:
+            self._handle(pkt, addr)
+        self._schedule_pacing()
+
+    def error_received(self, exc):
+        '''
+        Function called by the loop when a send or receive failed
+        param exc : exception raised by the socket
+        '''
+        logger.error(f"Socket error: {exc}")
+
+    def _sendto(self, payload, addr):
+        '''
+        Function to send a datagram to a client through the transport
+        param payload : bytes to send
+        param addr : address of the client
+        '''
+        self.transport.sendto(payload, addr)
+
+    def _send_datagrams(self, datagrams, addr):
+        '''
+        Function to send several datagrams to a client through the
+        transport, one at a time
+        param datagrams : list of (header, payload) of the datagrams
+        param addr : address of the client
+        '''
+        for header, payload in datagrams:
+            self.transport.sendto(header + payload, addr)
+
+    def resend(self, *args):
+        '''
+        Timer function to resend contents of the window to a client, packets
+        held back by the pacer are sent once it allows
+        param hostname : hostname of the client
+        param port : port to reach the client at
+        '''
+        super().resend(*args)
+        self._schedule_pacing()
+
+    def _compressed(self, addr):
+        '''
+        Function called by the compressor once the piece a client waits on is
+        compressed, has the loop load its window
+        param addr : address of the client
+        '''
+        self.refill.append(addr)
+        self.loop.call_soon_threadsafe(self._refill)
+
+    def _refill(self):
+        '''
+        Function run by the loop to load and send the windows of the clients
+        whose next piece was compressed
+        '''
+        self._refill_windows()
+        self._schedule_pacing()
+
+    def _schedule_pacing(self):
+        '''
+        Function to wake the loop up when the first client waiting on its
+        pacer can send again
+        '''
+        if self.pacing is not None or len(self.paced) == 0:
+            return
+        delay = self._recv_timeout()
+        self.pacing = asyncio.get_running_loop().call_later(delay, self._pace)
+
+    def _pace(self):
+        '''
+        Function run by the loop to send the packets of clients that were
+        waiting on their pacer
+        '''
+        self.pacing = None
+        self._send_paced()
+        self._schedule_pacing()
+
+
+def new_server(port, file_mgr):
+    '''
+    Function to create the UDP Server of the engine set by P2P_SERVER_ENGINE
+    param port : the port to run the server on
+    param file_mgr : the file manager that the server uses for file
+                     operations
+    '''
+    if constants.P2P_SERVER_ENGINE == 'asyncio':
+        return myAsyncUDPServer(port, file_mgr)
+    return myUDPServer(port, file_mgr)
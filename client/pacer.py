@@ -0,0 +1,156 @@
+import time
+import logging
+
+import constants
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Pacer():
+    '''
+    Class for the congestion window and send pacing of one transfer. The
+    window grows with every ACK (slow start, then additive increase) and is
+    cut on loss. Packets are released through a token bucket filled at a
+    rate derived from the window and the smoothed round trip time
+    '''
+    def __init__(self, max_window=constants.MAX_WINDOW_SIZE):
+        '''
+        Constructor for the pacer
+        param max_window : largest congestion window allowed, normally the
+                           window negotiated with the receiver
+        '''
+        self.max_window = max_window
+        self.cwnd = float(min(constants.PACER_INITIAL_CWND, max_window))
+        self.ssthresh = float(max_window)
+        self.srtt = None  # smoothed round trip time of the connection
+        self.tokens = float(constants.PACER_MAX_BURST)
+        self.last_refill = time.monotonic()
+        self.last_cut = 0.0  # time of the last window reduction
+
+        # delivery rate estimator, bytes acknowledged per second
+        self.delivery_rate = 0.0
+        self.delivered = 0
+        self.sample_start = self.last_refill
+
+    def pacing_rate(self):
+        '''
+        Function to get the current pacing rate in packets per second,
+        None if no round trip time has been measured yet
+        '''
+        if self.srtt is None:
+            return None
+        gain = constants.PACER_GAIN
+        if self.cwnd < self.ssthresh:  # let slow start outrun the window
+            gain = constants.PACER_GAIN_SLOW_START
+        return gain * self.cwnd / max(self.srtt, constants.PACER_MIN_RTT)
+
+    def _refill(self):
+        '''
+        Function to add the tokens earned since the last refill
+        '''
+        now = time.monotonic()
+        rate = self.pacing_rate()
+        if rate is None:
+            self.tokens = float(constants.PACER_MAX_BURST)
+        else:
+            self.tokens = min(float(constants.PACER_MAX_BURST),
+                              self.tokens + (now - self.last_refill) * rate)
+        self.last_refill = now
+
+    def allowance(self, in_flight, retransmit=False):
+        '''
+        Function to get the number of packets that can be sent right now
+        param in_flight : number of packets sent and not yet acknowledged
+        param retransmit : retransmissions are not bound by the window as
+                           the packets are already counted in flight
+        '''
+        self._refill()
+        tokens = int(self.tokens)
+        if retransmit:
+            return tokens
+        return max(0, min(int(self.cwnd) - in_flight, tokens))
+
+    def on_send(self):
+        '''
+        Function to take a token for a packet that was sent
+        '''
+        self.tokens -= 1
+
+    def starved(self):
+        '''
+        Function to check whether sending waits for a token. A transfer held
+        back by its window only is not, its next send is driven by an ack
+        '''
+        return self.tokens < 1
+
+    def next_send_time(self):
+        '''
+        Function to get the monotonic time at which the next token is
+        available
+        '''
+        rate = self.pacing_rate()
+        if rate is None or self.tokens >= 1:
+            return self.last_refill
+        return self.last_refill + (1 - self.tokens) / rate
+
+    def on_ack(self, nbytes, srtt=None):
+        '''
+        Function to update the pacer for an acknowledged packet
+        param nbytes : payload bytes the packet carried
+        param srtt : smoothed round trip time of the connection, None if it
+                     has not been measured yet
+        '''
+        if srtt is not None:
+            self.srtt = srtt
+
+        if self.cwnd < self.ssthresh:  # slow start
+            self.cwnd += 1
+        else:  # additive increase, one packet per window
+            self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, float(self.max_window))
+
+        # sample the delivery rate once every round trip
+        self.delivered += nbytes
+        now = time.monotonic()
+        elapsed = now - self.sample_start
+        if elapsed >= max(self.srtt or 0.0, constants.PACER_MIN_RTT):
+            sample = self.delivered / elapsed
+            if self.delivery_rate == 0.0:
+                self.delivery_rate = sample
+            else:
+                self.delivery_rate += (sample - self.delivery_rate) / 4
+            self.delivered = 0
+            self.sample_start = now
+
+    def on_loss(self):
+        '''
+        Function to halve the window when a packet was found lost, at most
+        once per round trip
+        '''
+        now = time.monotonic()
+        if now - self.last_cut < (self.srtt or 0.0):
+            return
+        self.last_cut = now
+        self.ssthresh = max(self.cwnd / 2, float(constants.PACER_MIN_CWND))
+        self.cwnd = self.ssthresh
+        logger.info(f"Loss detected, congestion window cut to {self.cwnd}")
+
+    def on_timeout(self):
+        '''
+        Function to collapse the window when the retransmit timer fired
+        '''
+        self.last_cut = time.monotonic()
+        self.ssthresh = max(self.cwnd / 2, float(constants.PACER_MIN_CWND))
+        self.cwnd = float(constants.PACER_MIN_CWND)
+        logger.info("Retransmit timeout, congestion window reset")
+
+    def get_stats(self):
+        '''
+        Function to get a dictionary of the pacer state for transfer stats
+        '''
+        return {'cwnd': self.cwnd,
+                'ssthresh': self.ssthresh,
+                'srtt': self.srtt,
+                'pacing_rate': self.pacing_rate(),
+                'delivery_rate': self.delivery_rate}
@@ -0,0 +1,155 @@
+import struct
+from collections import namedtuple
+
+import constants
+
+# version, type, flags, session id, sequence number, file offset
+HEADER = struct.Struct('!BBHIIQ')
+# file number, window size, first piece and number of pieces (0 for all)
+# carried by a request packet
+REQUEST = struct.Struct('!IIII')
+# bit mask of the codecs the client accepts, optional after the request
+CODECS = struct.Struct('!B')
+
+Packet = namedtuple('Packet', ['version', 'type', 'flags', 'session',
+                               'seq_no', 'offset', 'payload'])
+
+
+def header_size(version):
+    '''
+    Function to get the header size of a packet format
+    param version : packet format version
+    '''
+    if version == constants.LEGACY_PACKET_VERSION:
+        return constants.LEGACY_HEADER_SIZE
+    return constants.HEADER_SIZE
+
+
+def payload_size(version):
+    '''
+    Function to get the largest data payload that fits in a datagram
+    param version : packet format version
+    '''
+    if version == constants.LEGACY_PACKET_VERSION:
+        return constants.LEGACY_DATA_PAYLOAD_SIZE
+    return constants.DATA_PAYLOAD_SIZE
+
+
+def seq_space(version):
+    '''
+    Function to get the number of sequence numbers of a packet format
+    param version : packet format version
+    '''
+    if version == constants.LEGACY_PACKET_VERSION:
+        return constants.LEGACY_MAX_SEQ_NO
+    return constants.MAX_SEQ_NO
+
+
+def encode_header(version, pkt_type, seq_no, session=0, offset=0, flags=0):
+    '''
+    Function to build the header of a datagram, sent gathered with its
+    payload
+    param version : packet format version
+    param pkt_type : type of the packet
+    param seq_no : sequence number of the packet
+    param session : transfer session id, not sent in the legacy format
+    param offset : file offset of the payload, not sent in the legacy format
+    param flags : packet flags, not sent in the legacy format
+    '''
+    if version == constants.LEGACY_PACKET_VERSION:
+        return bytes((seq_no, pkt_type))
+    return HEADER.pack(version, pkt_type, flags, session, seq_no, offset)
+
+
+def encode(version, pkt_type, seq_no, payload=b'', session=0, offset=0,
+           flags=0):
+    '''
+    Function to build a datagram
+    param version : packet format version
+    param pkt_type : type of the packet
+    param seq_no : sequence number of the packet
+    param payload : bytes carried after the header, a memoryview is joined
+                    to the header without copying it first
+    param session : transfer session id, not sent in the legacy format
+    param offset : file offset of the payload, not sent in the legacy format
+    param flags : packet flags, not sent in the legacy format
+    '''
+    return encode_header(version, pkt_type, seq_no, session, offset,
+                         flags) + payload
+
+
+def decode(data, version=None):
+    '''
+    Function to parse a datagram into a Packet. Without a version the format
+    is detected from the length and first byte, which is only safe for the
+    requests and ACKs a server receives: legacy ones are 2 or 3 bytes, shorter
+    than the versioned header. A legacy data packet is as long as a versioned
+    one and starts with its seq byte, so one with seq 2 would be taken for
+    versioned; receivers of data packets (myUDPClient.recv) must pass the
+    version the request negotiated. Detection is used by the listen loops of
+    myUDPServer.listen and myAsyncUDPServer.datagram_received
+    param data : bytes of the datagram, or a memoryview the payload is then
+                 a view into
+    param version : packet format version, None to detect it
+    '''
+    if version is None:
+        version = constants.LEGACY_PACKET_VERSION
+        if len(data) >= HEADER.size and data[0] == constants.PACKET_VERSION:
+            version = constants.PACKET_VERSION
+    if version == constants.LEGACY_PACKET_VERSION:
+        if len(data) < constants.LEGACY_HEADER_SIZE:
+            raise ValueError(f"Packet too short: {bytes(data)}")
+        return Packet(version, data[1], 0, 0, data[0], None, data[2:])
+    if len(data) < HEADER.size:
+        raise ValueError(f"Packet too short: {bytes(data)}")
+    return Packet(*HEADER.unpack_from(data), data[HEADER.size:])
+
+
+def encode_request(version, file_no, window_size, first_piece=0,
+                   piece_count=0, codecs=0):
+    '''
+    Function to build the payload of a request packet
+    param version : packet format version
+    param file_no : number of the file requested
+    param window_size : window size asked for by the client
+    param first_piece : first piece requested, not sent in the legacy format
+    param piece_count : number of pieces requested, 0 for the rest of the
+                        file, not sent in the legacy format
+    param codecs : bit mask of the codecs the client accepts, not sent if
+                   none or in the legacy format. Peers that do not know it
+                   ignore it and send pieces as they are
+    '''
+    if version == constants.LEGACY_PACKET_VERSION:  # fixed window
+        return int(file_no).to_bytes(1, "big")
+    payload = REQUEST.pack(int(file_no), int(window_size), first_piece,
+                           piece_count)
+    if codecs != 0:
+        payload += CODECS.pack(codecs)
+    return payload
+
+
+def decode_request(packet):
+    '''
+    Function to get the file number, window size, first piece, piece count
+    and accepted codecs of a request packet
+    param packet : decoded request Packet
+    '''
+    if packet.version == constants.LEGACY_PACKET_VERSION:
+        if len(packet.payload) == 0:
+            raise ValueError("Request without a file number")
+        return packet.payload[0], constants.LEGACY_WINDOW_SIZE, 0, 0, 0
+    if len(packet.payload) < REQUEST.size:
+        raise ValueError("Request without a file number")
+    codecs = 0
+    if len(packet.payload) >= REQUEST.size + CODECS.size:
+        codecs = CODECS.unpack_from(packet.payload, REQUEST.size)[0]
+    return REQUEST.unpack_from(packet.payload) + (codecs,)
+
+
+def codec_of(flags):
+    '''
+    Function to get the codec of the payload of a data packet, 0 if it is
+    not compressed
+    param flags : flags of the packet
+    '''
+    return flags >> constants.FLAG_CODEC_SHIFT
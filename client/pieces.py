@@ -0,0 +1,315 @@
+import os
+import struct
+import hashlib
+import logging
+import threading
+from collections import deque, namedtuple
+from pathlib import Path
+
+import yaml
+
+import constants
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# piece size, number of pieces, file size, followed by the sha1 of the file
+MANIFEST = struct.Struct('!IIQ')
+
+Manifest = namedtuple('Manifest', ['piece_size', 'piece_count', 'file_size',
+                                   'file_hash'])
+
+
+def piece_count(file_size, piece_size=constants.PIECE_SIZE):
+    '''
+    Function to get the number of pieces of a file
+    param file_size : size of the file in bytes
+    param piece_size : number of bytes in a piece
+    '''
+    return (file_size + piece_size - 1) // piece_size
+
+
+def encode_manifest(piece_size, file_size, file_hash):
+    '''
+    Function to build the first packet of a transfer, it replaces the bare
+    file hash sent to legacy peers
+    param piece_size : number of bytes in a piece
+    param file_size : size of the file in bytes
+    param file_hash : sha1 of the whole file as bytes, None for an empty file
+    '''
+    return MANIFEST.pack(piece_size, piece_count(file_size, piece_size),
+                         file_size) + (file_hash or b'')
+
+
+def decode_manifest(payload):
+    '''
+    Function to parse the first packet of a transfer into a Manifest
+    param payload : payload of the packet
+    '''
+    if len(payload) < MANIFEST.size:
+        raise ValueError(f"Manifest too short: {payload}")
+    piece_size, count, file_size = MANIFEST.unpack_from(payload)
+    if piece_size == 0:
+        raise ValueError("Manifest without a piece size")
+    file_hash = payload[MANIFEST.size:].decode(encoding='utf-8') or None
+    return Manifest(piece_size, count, file_size, file_hash)
+
+
+def encode_hashes(hashes, first, payload_size):
+    '''
+    Function to split a list of piece hashes into packet payloads. Yields
+    the payload and the index of its first piece
+    param hashes : sha1 digests of the pieces to send
+    param first : index of the first piece in the list
+    param payload_size : largest payload that fits in a datagram
+    '''
+    per_packet = payload_size // constants.PIECE_HASH_SIZE
+    for i in range(0, len(hashes), per_packet):
+        yield (b''.join(hashes[i:i + per_packet]), first + i)
+
+
+def progress_path(file_location):
+    '''
+    Function to get the path of the sidecar file recording the progress of
+    a download
+    param file_location : path of the file downloaded
+    '''
+    path = Path(file_location)
+    return path.with_name(path.name + constants.PROGRESS_SUFFIX)
+
+
+def save_progress(checker, file_location):
+    '''
+    Function to record the manifest and the verified pieces of a download
+    next to the file, replaces the old record in one step
+    param checker : piece checker of the download
+    param file_location : path of the file downloaded
+    '''
+    manifest = checker.manifest
+    with checker.lock:
+        verified = list(checker.verified)
+    bitmap = bytearray((manifest.piece_count + 7) // 8)
+    for index in verified:
+        bitmap[index >> 3] |= 0x80 >> (index & 7)
+    progress = {'file_hash': manifest.file_hash,
+                'piece_size': manifest.piece_size,
+                'piece_count': manifest.piece_count,
+                'file_size': manifest.file_size,
+                'verified': bitmap.hex()}
+    path = progress_path(file_location)
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        with open(tmp_path, 'w') as f:
+            yaml.dump(progress, f, Dumper=yaml.SafeDumper)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Progress of {file_location} not saved: {e}")
+
+
+def load_progress(file_location):
+    '''
+    Function to get a piece checker with the verified pieces of an earlier
+    download of a file, None if there is nothing to resume
+    param file_location : path of the file downloaded
+    '''
+    path = progress_path(file_location)
+    if not path.is_file() or not Path(file_location).is_file():
+        return None
+    try:
+        with open(path, 'r') as f:
+            progress = yaml.load(f, Loader=yaml.SafeLoader)
+        manifest = Manifest(int(progress['piece_size']),
+                            int(progress['piece_count']),
+                            int(progress['file_size']),
+                            progress['file_hash'])
+        bitmap = bytes.fromhex(progress['verified'])
+    except (OSError, yaml.YAMLError, KeyError, TypeError, ValueError) as e:
+        logger.warning(f"Progress of {file_location} not loaded: {e}")
+        return None
+    # the file was cut short since, its pieces can not be trusted
+    if Path(file_location).stat().st_size != manifest.file_size or \
+            len(bitmap) != (manifest.piece_count + 7) // 8:
+        logger.warning(f"Progress of {file_location} does not match the file")
+        return None
+    checker = PieceChecker(manifest)
+    checker.verified = {i for i in range(manifest.piece_count)
+                        if bitmap[i >> 3] & (0x80 >> (i & 7))}
+    return checker
+
+
+def remove_progress(file_location):
+    '''
+    Function to remove the progress record of a download
+    param file_location : path of the file downloaded
+    '''
+    path = progress_path(file_location)
+    if path.exists():
+        os.remove(path)
+
+
+class PieceChecker():
+    '''
+    Class to verify the pieces of a file as its blocks are written. Blocks
+    of a piece have to be fed in order, feeding the first block of a piece
+    again starts it over
+    '''
+    def __init__(self, manifest):
+        '''
+        Constructor for the piece checker
+        param manifest : Manifest received at the start of the transfer
+        '''
+        self.manifest = manifest
+        self.hashes = {}  # expected digest of each piece
+        self.hashers = {}  # running hash of the pieces being received
+        self.received = {}  # bytes received of the pieces being received
+        self.verified = set()
+        self.failed = set()
+        # pieces of a swarm download are fed by several peers at once
+        self.lock = threading.Lock()
+
+    def piece_length(self, index):
+        '''
+        Function to get the number of bytes in a piece
+        param index : index of the piece
+        '''
+        start = index * self.manifest.piece_size
+        return min(self.manifest.piece_size, self.manifest.file_size - start)
+
+    def add_hashes(self, first, payload):
+        '''
+        Function to add the digests carried by a piece hash packet
+        param first : index of the first piece in the payload
+        param payload : concatenated sha1 digests
+        '''
+        size = constants.PIECE_HASH_SIZE
+        with self.lock:
+            for i in range(len(payload) // size):
+                self.hashes[first + i] = payload[i * size:(i + 1) * size]
+
+    def feed(self, block, offset):
+        '''
+        Function to hash a block written to the file, verifies every piece
+        the block completes. Returns the indices of the pieces that failed
+        param block : bytes written
+        param offset : offset in the file the block was written at
+        '''
+        with self.lock:
+            return self._feed(block, offset)
+
+    def _feed(self, block, offset):
+        '''
+        Function to hash a block written to the file. Must be called with the
+        lock held
+        param block : bytes written
+        param offset : offset in the file the block was written at
+        '''
+        failed = []
+        piece_size = self.manifest.piece_size
+        view = memoryview(block)
+        while len(view) > 0:
+            index = offset // piece_size
+            start = offset - index * piece_size
+            if start == 0:  # (re)started piece
+                self.hashers[index] = hashlib.sha1()
+                self.received[index] = 0
+            if index not in self.hashers or self.received[index] != start:
+                raise ValueError(f"Piece {index} not fed in order")
+            part = view[:piece_size - start]
+            self.hashers[index].update(part)
+            self.received[index] += len(part)
+            view = view[len(part):]
+            offset += len(part)
+            if self.received[index] == self.piece_length(index):
+                if not self._verify(index):
+                    failed.append(index)
+        return failed
+
+    def _verify(self, index):
+        '''
+        Function to check a completed piece against its digest
+        param index : index of the piece
+        '''
+        digest = self.hashers.pop(index).digest()
+        del self.received[index]
+        if self.hashes.get(index) == digest:
+            self.verified.add(index)
+            self.failed.discard(index)
+            return True
+        logger.warning(f"Piece {index} failed hash check")
+        self.failed.add(index)
+        self.verified.discard(index)
+        return False
+
+    def missing(self):
+        '''
+        Function to get the pieces that are not verified, either failed or
+        never completed
+        '''
+        with self.lock:
+            verified = set(self.verified)
+        return sorted(set(range(self.manifest.piece_count)) - verified)
+
+    def missing_ranges(self):
+        '''
+        Function to group the missing pieces into (first piece, piece count)
+        ranges to request
+        '''
+        ranges = []
+        for index in self.missing():
+            if ranges and ranges[-1][0] + ranges[-1][1] == index:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([index, 1])
+        return [tuple(r) for r in ranges]
+
+    def complete(self):
+        '''
+        Function to check whether every piece of the file is verified
+        '''
+        return len(self.verified) == self.manifest.piece_count
+
+
+class ChunkQueue():
+    '''
+    Class for the chunks of pieces shared by the peers of a swarm download.
+    A peer that runs out of chunks waits while other peers still hold some,
+    so a chunk given back by a failed peer is taken over by another one
+    '''
+    def __init__(self, ranges, chunk_pieces=constants.SWARM_CHUNK_PIECES):
+        '''
+        Constructor for the chunk queue
+        param ranges : (first piece, piece count) ranges to fetch
+        param chunk_pieces : most pieces in a chunk
+        '''
+        self.chunks = deque()
+        for first, count in ranges:
+            for i in range(first, first + count, chunk_pieces):
+                self.chunks.append((i, min(chunk_pieces, first + count - i)))
+        self.busy = 0  # chunks held by peers
+        self.cond = threading.Condition()
+
+    def take(self):
+        '''
+        Function to get the next chunk to fetch, None once all chunks are
+        fetched
+        '''
+        with self.cond:
+            while len(self.chunks) == 0 and self.busy > 0:
+                self.cond.wait()
+            if len(self.chunks) == 0:
+                return None
+            self.busy += 1
+            return self.chunks.popleft()
+
+    def done(self, chunk, success):
+        '''
+        Function to return a chunk taken from the queue
+        param chunk : chunk returned by take
+        param success : whether the chunk was fetched, it is queued again
+                        otherwise
+        '''
+        with self.cond:
+            self.busy -= 1
+            if not success:
+                self.chunks.appendleft(chunk)
+            self.cond.notify_all()
@@ -0,0 +1,68 @@
+import constants
+
+
+class RTOEstimator():
+    '''
+    Class for the retransmission timeout of one connection, computed from
+    round trip samples with the Jacobson/Karels estimator. Samples must
+    only be taken from packets sent once (Karn's rule)
+    '''
+    def __init__(self, initial=constants.RTO_INITIAL,
+                 min_rto=constants.RTO_MIN, max_rto=constants.RTO_MAX):
+        '''
+        Constructor for the estimator
+        param initial : timeout to use before the first sample
+        param min_rto : lower bound of the timeout
+        param max_rto : upper bound of the timeout, also for backoff
+        '''
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None  # smoothed round trip time
+        self.rttvar = None  # round trip time variation
+        self.base_rto = min(max(initial, min_rto), max_rto)
+        self.rto = self.base_rto
+        self.samples = 0
+
+    def sample(self, rtt):
+        '''
+        Function to add a round trip time sample, clears any backoff
+        param rtt : measured round trip time in seconds
+        '''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        self.samples += 1
+        rto = self.srtt + max(constants.RTO_CLOCK_GRANULARITY,
+                              4 * self.rttvar)
+        self.base_rto = min(max(rto, self.min_rto), self.max_rto)
+        self.rto = self.base_rto
+
+    def backoff(self):
+        '''
+        Function to double the timeout after it expired
+        '''
+        self.rto = min(self.rto * 2, self.max_rto)
+
+    def reset_backoff(self):
+        '''
+        Function to go back to the computed timeout once traffic flows again
+        '''
+        self.rto = self.base_rto
+
+    def get_rto(self):
+        '''
+        Function to get the current timeout in seconds
+        '''
+        return self.rto
+
+    def get_stats(self):
+        '''
+        Function to get a dictionary of the estimator state for stats
+        '''
+        return {'rto': self.rto,
+                'srtt': self.srtt,
+                'rttvar': self.rttvar,
+                'rtt_samples': self.samples}
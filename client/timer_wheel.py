@@ -0,0 +1,206 @@
+import math
+import time
+import logging
+import threading
+
+import constants
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class WheelTimer():
+    '''
+    Class for a timer handle returned by the timer wheel
+    '''
+    def __init__(self, target, callback, args):
+        '''
+        Constructor for the timer handle
+        param target : tick at which the timer expires
+        param callback : function to call on expiry
+        param args : arguments to call the function with
+        '''
+        self.target = target
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.fired = False
+
+    def cancel(self):
+        '''
+        Function to mark the timer as cancelled, the wheel drops it
+        '''
+        self.cancelled = True
+
+
+class TimerWheel():
+    '''
+    Class for a hashed timer wheel. All timers are run by a single thread,
+    arming and cancelling a timer is O(1)
+    '''
+    def __init__(self, tick=constants.TIMER_WHEEL_TICK,
+                 slots=constants.TIMER_WHEEL_SLOTS):
+        '''
+        Constructor for the timer wheel
+        param tick : duration of a tick in seconds
+        param slots : number of slots in the wheel
+        '''
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.origin = time.monotonic()
+        self.last_tick = 0  # last tick that was processed
+        self.count = 0  # number of armed timers
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def _now_tick(self):
+        '''
+        Function to get the tick the wheel should be at right now
+        '''
+        return int((time.monotonic() - self.origin) / self.tick)
+
+    def start(self):
+        '''
+        Function to start the thread that runs the timers
+        '''
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Function to stop the timer thread, armed timers never fire
+        '''
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def schedule(self, delay, callback, *args):
+        '''
+        Function to arm a timer
+        param delay : seconds until the timer expires
+        param callback : function to call on expiry
+        param args : arguments to call the function with
+        '''
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self.cond:
+            timer = WheelTimer(self._now_tick() + ticks, callback, args)
+            self.slots[timer.target % len(self.slots)].add(timer)
+            self.count += 1
+            # wake up the thread if it is waiting with an empty wheel
+            if self.count == 1:
+                self.cond.notify()
+        return timer
+
+    def cancel(self, timer):
+        '''
+        Function to disarm a timer
+        param timer : handle returned by schedule
+        '''
+        with self.cond:
+            timer.cancel()
+            slot = self.slots[timer.target % len(self.slots)]
+            if timer in slot:
+                slot.remove(timer)
+                self.count -= 1
+
+    def _expired(self):
+        '''
+        Function to advance the wheel to the current tick and collect the
+        timers that expired on the way. Must be called with the lock held
+        '''
+        now_tick = self._now_tick()
+        expired = []
+        # a full turn of the wheel visits every slot
+        start = max(self.last_tick + 1, now_tick - len(self.slots) + 1)
+        for tick in range(start, now_tick + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for timer in [t for t in slot if t.target <= now_tick]:
+                slot.remove(timer)
+                self.count -= 1
+                expired.append(timer)
+        self.last_tick = max(self.last_tick, now_tick)
+        return expired
+
+    def _run(self):
+        '''
+        Function run by the timer thread, sleeps until the next tick while
+        timers are armed and until a timer is armed otherwise
+        '''
+        while True:
+            with self.cond:
+                if self.stopped:
+                    return
+                if self.count == 0:
+                    self.cond.wait()
+                else:
+                    next_tick = self.origin + (self.last_tick + 1) * self.tick
+                    self.cond.wait(max(0.0, next_tick - time.monotonic()))
+                if self.stopped:
+                    return
+                expired = self._expired()
+            for timer in expired:
+                if timer.cancelled:
+                    continue
+                timer.fired = True
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    logger.error(f"Timer callback failed: {e}")
+
+
+class LoopTimers():
+    '''
+    Class for timers run by an asyncio event loop, with the interface of the
+    timer wheel. Must only be used from the loop thread
+    '''
+    def __init__(self, loop):
+        '''
+        Constructor for the loop timers
+        param loop : event loop running the timers
+        '''
+        self.loop = loop
+
+    def start(self):
+        '''
+        Function kept for the timer wheel interface, the loop runs the timers
+        '''
+
+    def stop(self):
+        '''
+        Function kept for the timer wheel interface, the loop runs the timers
+        '''
+
+    def schedule(self, delay, callback, *args):
+        '''
+        Function to arm a timer
+        param delay : seconds until the timer expires
+        param callback : function to call on expiry
+        param args : arguments to call the function with
+        '''
+        timer = WheelTimer(self.loop.time() + delay, callback, args)
+        timer.handle = self.loop.call_later(delay, self._fire, timer)
+        return timer
+
+    def cancel(self, timer):
+        '''
+        Function to disarm a timer
+        param timer : handle returned by schedule
+        '''
+        timer.cancel()
+        timer.handle.cancel()
+
+    def _fire(self, timer):
+        '''
+        Function run by the loop when a timer expires
+        param timer : timer that expired
+        '''
+        if timer.cancelled:
+            return
+        timer.fired = True
+        try:
+            timer.callback(*timer.args)
+        except Exception as e:
+            logger.error(f"Timer callback failed: {e}")